@@ -0,0 +1,73 @@
+#!/bin/env python3
+'''
+     Title: daemon_latency
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+   Purpose: Compare the time for a sort by a new `field_sort.py`
+            process with the time for a sort by `field_sort_client.py`
+            and a running daemon.
+
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import subprocess
+import os
+import re
+import sys
+import time
+import statistics
+import tempfile
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+field_sort = cwd + "/../field_sort.py"
+field_sort_client = cwd + "/../field_sort_client.py"
+
+RUNS = 20
+
+marked = ''.join(f"Name {n}, __{(n * 7919) % 1000}__\n" for n in range(1000))
+lines = re.sub('__', '', marked)
+args = ['--key=1:number', marked, lines]
+
+
+def time_runs(command):
+    times = []
+    for run in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run(command + args, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times):
+    print(f"{name:<10} median {statistics.median(times)*1000:8.1f} ms"
+          f"   min {min(times)*1000:8.1f} ms")
+
+
+with tempfile.TemporaryDirectory() as folder:
+    os.environ['FIELD_SORT_SOCKET'] = os.path.join(folder, 'field_sort.sock')
+
+    report('process', time_runs([sys.executable, field_sort]))
+
+    daemon = subprocess.Popen([sys.executable, field_sort, '--daemon'])
+    try:
+        while not os.path.exists(os.environ['FIELD_SORT_SOCKET']):
+            time.sleep(0.05)
+        report('daemon', time_runs([sys.executable, field_sort_client]))
+    finally:
+        daemon.terminate()
+        daemon.wait()
@@ -0,0 +1,51 @@
+#!/bin/env python3
+'''
+     Title: dialog_construction
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+   Purpose: Time how long the sortkey dialog takes to be built and
+            shown for pages with more and more fields.
+            Needs a display.
+
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import time
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, cwd + "/..")
+import field_sort
+from gi.repository import Gtk
+
+COUNTS = (1, 10, 40, 160, 640)
+LINES  = 1000
+
+field_sort.load_languages()
+options = field_sort.read_options([])
+
+for count in COUNTS:
+    start = time.perf_counter()
+    dialog = field_sort.SortkeyDialog(None)
+    dialog.show_guts(count, options, LINES)
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+    elapsed = time.perf_counter() - start
+    dialog.destroy()
+    print(f"{count:5d} fields {elapsed*1000:10.1f} ms")
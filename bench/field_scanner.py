@@ -0,0 +1,69 @@
+#!/bin/env python3
+'''
+     Title: field_scanner
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+   Purpose: Time how long the fields of hostile lines take to be
+            found: snake_case with no closing `__`, runs of
+            underscores, fields that are never closed and several
+            kinds of markup mixed together. The time per character
+            should stay the same as the lines get longer. The
+            pattern that was used before is timed too, to compare.
+
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import sys
+import time
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, cwd + "/..")
+import field_sort
+
+SIZES = (1000, 10000, 100000, 1000000)
+KINDS = (field_sort.ID_MARK, field_sort.ID_BOLD, field_sort.ID_ITALIC)
+
+# the pattern used before
+OLD_TEMPLATE = '(?P<{kind}>{c}{c}[^{c}]*(?:(?:{c}[^{c}]+))*{c}{c})'
+OLD_PATTERN  = re.compile('|'.join(OLD_TEMPLATE.format(kind=kind, c=re.escape(field_sort.Markup_list[kind]))
+                                   for kind in KINDS))
+
+CORPUS = {
+    'snake_case': lambda size: '__' + ('snake_case_name_' * size)[:size],
+    'underscores': lambda size: '_' * size,
+    'unclosed':   lambda size: ('__a_' + '_b' * 3) * (size // 10),
+    'mixed':      lambda size: ('__a**b//c_*/' * size)[:size],
+    'fields':     lambda size: ('__a__ **b** //c// ' * size)[:size],
+}
+
+
+def time_it(find, line):
+    start = time.perf_counter()
+    count = sum(1 for found in find(line))
+    return time.perf_counter() - start, count
+
+
+print(f"{'line':<12} {'size':>8} {'found':>7} {'ns/char':>8} {'old ns/char':>12}")
+for name, make in CORPUS.items():
+    for size in SIZES:
+        line = make(size)
+        new, count = time_it(lambda line: field_sort.field_pattern(KINDS).finditer(line), line)
+        old, count = time_it(lambda line: OLD_PATTERN.finditer(line), line)
+        print(f"{name:<12} {len(line):8d} {count:7d} {new/len(line)*1e9:8.1f} {old/len(line)*1e9:12.1f}")
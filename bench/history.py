@@ -0,0 +1,291 @@
+#!/bin/env python3
+'''
+     Title: history
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+     Usage: bench/history.py [--label=TEXT] [--baseline=ID] [--repeat=N]
+                             [--lines=N] [--history=FILE] [--no-save]
+   Purpose: Time each stage of a sort, keep the times in a history
+            with where they were taken (machine, Python and ICU) and
+            compare them with an earlier run, the baseline. A change
+            is only called faster or slower if it is bigger than the
+            noise seen in the two runs.
+
+            The history is kept in bench/history.json. The baseline
+            is the run with the given ID, by default the last run on
+            the same machine with the same Python.
+
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, cwd + "/..")
+import field_sort
+
+HISTORY = cwd + "/history.json"
+
+# changes smaller than this are never reported
+MIN_CHANGE = 0.03
+
+# --top=TOP_LINES must take less than this part of a full sort
+TOP_LINES   = 20
+TOP_MAXIMUM = 0.75
+
+
+# --------------------------------------
+def metadata():
+    '''
+          Name: metadata
+         Usage: where = metadata()
+       Purpose: Describe where the benchmark is run.
+    Parameters: (none)
+       Returns: where -- {'machine':..., 'python':..., 'icu':..., 'commit':...}
+    '''
+    try:
+        import icu
+        icu_version = icu.ICU_VERSION
+    except ImportError:
+        icu_version = None
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=cwd,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'machine': ' '.join((platform.node(), platform.machine(), platform.processor())).strip(),
+        'python':  platform.python_implementation() + ' ' + platform.python_version(),
+        'icu':     icu_version,
+        'commit':  commit,
+    }
+
+
+# --------------------------------------
+def time_stages(lines):
+    '''
+          Name: time_stages
+         Usage: times = time_stages(lines)
+       Purpose: Sort a page once, timing each stage.
+    Parameters: lines -- number of lines on the page
+       Returns: times -- {stage:seconds,...}
+    '''
+    marked = ''.join(f"Name {n}, __{(n * 7919) % 1000}__ __w{n % 97}__\n" for n in range(lines))
+    text = re.sub('__', '', marked)
+    sortkeys = (('1', field_sort.ID_NUMBER, field_sort.ID_ASCENDING, field_sort.ID_NONE),
+                ('2', field_sort.ID_TEXT, field_sort.ID_DESCENDING, field_sort.AppLanguage or field_sort.ID_NONE))
+
+    times = {}
+    start = time.perf_counter()
+    marked_lines = field_sort.Lines(marked)
+    text_lines   = field_sort.Lines(text)
+    times['lines'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fields = field_sort.get_fields(text_lines, marked_lines)[1]
+    times['get_fields'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    keyed = field_sort.assign_keys(fields, sortkeys)
+    times['assign_keys'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ordered = field_sort.sort_fields(keyed, field_sort.find_runs(keyed))
+    times['sort_fields'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    marked_lines.join(field_sort.extract_order(ordered))
+    times['join'] = time.perf_counter() - start
+
+    # --top, which does neither assign_keys nor sort_fields
+    start = time.perf_counter()
+    keys = field_sort.SortPlan(sortkeys).line_keys(fields)
+    field_sort.select_top(keys, range(0, len(keys)), TOP_LINES)
+    times['top'] = time.perf_counter() - start
+
+    return times
+
+
+# --------------------------------------
+def check_top(run):
+    '''
+          Name: check_top
+         Usage: ok = check_top(run)
+       Purpose: Check that sorting only the top lines is much faster
+                than sorting them all, as it is O(n log top) and not
+                O(n log n).
+    Parameters: run -- the current run
+       Returns: ok  -- True if it is
+    '''
+    full = spread(run['stages']['assign_keys'])[0] + spread(run['stages']['sort_fields'])[0]
+    top  = spread(run['stages']['top'])[0]
+    print(f"top {TOP_LINES} of {run['lines']} lines: {top*1000:.2f}ms, "
+          f"{top/full*100:.0f}% of a full sort, at most {TOP_MAXIMUM*100:.0f}%")
+    if top > full * TOP_MAXIMUM:
+        print('warning: --top is not faster than a full sort')
+        return False
+    return True
+
+
+# --------------------------------------
+def spread(times):
+    '''
+          Name: spread
+         Usage: median, noise = spread(times)
+       Purpose: How long a stage takes and how much that varies.
+    Parameters: times  -- seconds, of the repeats
+       Returns: median -- seconds
+                noise  -- the interquartile range over the median
+    '''
+    median = statistics.median(times)
+    if len(times) < 4 or median == 0:
+        return median, 0.0
+    quartiles = statistics.quantiles(times, n=4)
+    return median, (quartiles[2] - quartiles[0]) / median
+
+
+# --------------------------------------
+def find_baseline(history, run, wanted):
+    '''
+          Name: find_baseline
+         Usage: baseline = find_baseline(history, run, wanted)
+       Purpose: Choose the run to compare with.
+    Parameters: history  -- [run,...], oldest first
+                run      -- the current run
+                wanted   -- ID of the baseline, or None for the last
+                            run on the same machine and Python
+       Returns: baseline -- a run, or None
+    '''
+    for earlier in reversed(history):
+        if wanted is not None:
+            if earlier['id'] == wanted:
+                return earlier
+        elif earlier['machine'] == run['machine'] and earlier['python'] == run['python']:
+            return earlier
+    return None
+
+
+# --------------------------------------
+def compare(baseline, run):
+    '''
+          Name: compare
+         Usage: compare(baseline, run)
+       Purpose: Print a table of how much faster or slower each stage
+                is than in the baseline.
+    Parameters: baseline -- an earlier run
+                run      -- the current run
+       Returns: (none)
+    '''
+    print(f"baseline {baseline['id']} {baseline['label']} "
+          f"({baseline['commit']}, {baseline['time']})")
+    if baseline['lines'] != run['lines']:
+        print(f"warning: the baseline sorted {baseline['lines']} lines, not {run['lines']}")
+    print(f"{'stage':<12} {'baseline':>10} {'now':>10} {'speedup':>8} {'noise':>7}")
+    for stage, times in run['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        before, before_noise = spread(baseline['stages'][stage])
+        after,  after_noise  = spread(times)
+        noise   = max(MIN_CHANGE, before_noise, after_noise)
+        speedup = before / after if after else float('inf')
+        if speedup > 1 + noise:
+            verdict = 'faster'
+        elif speedup < 1 / (1 + noise):
+            verdict = 'SLOWER'
+        else:
+            verdict = 'same'
+        print(f"{stage:<12} {before*1000:8.2f}ms {after*1000:8.2f}ms "
+              f"{speedup:7.2f}x {noise*100:6.1f}% {verdict}")
+
+
+# --------------------------------------
+def main():
+    '''
+          Name: main
+         Usage: main()
+       Purpose: Isolates execution of the program from importing.
+    Parameters: (none)
+       Returns: (none)
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--label', default='')
+    parser.add_argument('--baseline', type=int)
+    parser.add_argument('--repeat', type=int, default=15)
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--history', default=HISTORY)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    field_sort.load_languages()
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as saved:
+            history = json.load(saved)
+
+    run = metadata()
+    run.update({
+        'id':     max([earlier['id'] for earlier in history], default=0) + 1,
+        'time':   datetime.datetime.now().isoformat(timespec='seconds'),
+        'label':  args.label,
+        'lines':  args.lines,
+        'stages': {},
+    })
+    time_stages(args.lines)   # warm up
+    for repeat in range(args.repeat):
+        for stage, seconds in time_stages(args.lines).items():
+            run['stages'].setdefault(stage, []).append(seconds)
+
+    print(f"run {run['id']} {run['label']} on {run['machine']}, {run['python']}, ICU {run['icu']}")
+    for stage, times in run['stages'].items():
+        median, noise = spread(times)
+        print(f"{stage:<12} {median*1000:8.2f}ms ±{noise*100:5.1f}%")
+    print()
+    top_ok = check_top(run)
+    print()
+
+    baseline = find_baseline(history, run, args.baseline)
+    if baseline is None:
+        print('no baseline to compare with')
+    else:
+        compare(baseline, run)
+
+    if not args.no_save:
+        history.append(run)
+        with open(args.history + '.new', 'w') as saving:
+            json.dump(history, saving, indent=1)
+        os.replace(args.history + '.new', args.history)
+
+    if not top_ok:
+        exit(1)
+
+
+# don't execute if imported
+if __name__ == '__main__':
+    main()
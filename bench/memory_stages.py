@@ -0,0 +1,48 @@
+#!/bin/env python3
+'''
+     Title: memory_stages
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+   Purpose: Measure the memory each stage of a sort uses, per line,
+            for larger and larger pages, so that a change that uses
+            more memory shows up here.
+
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import sys
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, cwd + "/..")
+import field_sort
+
+SIZES = (1000, 10000, 100000)
+
+field_sort.load_languages()
+
+for size in SIZES:
+    marked = ''.join(f"Name {n}, __{(n * 7919) % 1000}__ __w{n % 97}__\n" for n in range(size))
+    lines = re.sub('__', '', marked)
+    options = field_sort.read_options(['--key=1:number', '--key=2', marked, lines])
+
+    report = field_sort.MemoryReport()
+    field_sort.sort_selection(options, report)
+    report.write(sys.stdout)
+    print()
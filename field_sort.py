@@ -2,15 +2,21 @@
 '''
      Title: Field Sort
  Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
-     Usage: **/field_sort.py %T %t
-            The command for this tool is: `**/field_sort.py %T %t`
+     Usage: **/field_sort.py -- %T
+            The command for this tool is: `**/field_sort.py -- %T`
             where `**` represents the path to the tool.
 
             `%T` is the selection with Zim markup.
             The fields are extracted from this.
 
-            `%t` is the selected text without Zim markup.
-            This is used for entire line sorting.
+            `%t`, the selected text without Zim markup, may be given
+            after `%T`, as older versions needed. Without it, the
+            markup is removed from `%T` for entire line sorting.
+
+            Options may be placed before the `--` and must be
+            written as `--name` or `--name=value`. The `--` ends the
+            options, so a selection that starts with `--` is never
+            taken for one. Run `field_sort.py --help` for the list.
 
    Purpose: Sort Zim Desktop Wiki lines by fields.
    Licence: This file is part of Field Sort.
@@ -41,10 +47,26 @@ import sys
 import re
 import numbers
 import functools
+import heapq
+import bisect
+import argparse
+import os
+import stat
+import io
+import json
+import socket
+import asyncio
+import contextlib
+import threading
+import subprocess
+import array
+import itertools
+import tracemalloc
+import concurrent.futures
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from gi.repository import Gtk, GLib
 
 import gettext
 _ = gettext.gettext
@@ -56,22 +78,102 @@ import locale
 # constants
 SUCCESS                    =  0
 EXIT_STATUS_SORT_CANCELLED =  1
+EXIT_STATUS_NOT_SORTED     =  3
 EXIT_STATUS_INTERNAL_ERROR = -1
 
-SCROLL_BAR_SIZE   = 17  # needed to adapt to window size
-ADDITIONAL_HEIGHT = 36  # needed to adapt to window size
-
 EMPTY_STRING = ''
 
+OPTION_PREFIX     = '--'
+OPTION_TERMINATOR = '--'
+KEY_SEPARATOR     = ':'
+
+# compiled once; a daemon keeps them for every request
+NEWLINES_PATTERN   = re.compile('(?:\r?\n)+')
+
+# the pattern for a field marked by a doubled character, like `__`;
+# it ends at the very next doubled character. Only one lazy quantifier,
+# so the time taken is in proportion to the length of the line whatever
+# is in it; see bench/field_scanner.py
+FIELD_TEMPLATE = '(?P<{kind}>{guard}{c}{c}.*?{guard}{c}{c})'
+FIELD_MARK_SIZE = 2
+
+# the markup Zim removes for %t: bold, italic (not the `//` of a URL),
+# mark, strike, verbatim, links, subscripts and superscripts. Each
+# leaves what is in its group. Empty marks go too, as for the fields.
+STRIP_PATTERN = re.compile(r"\*\*(.*?)\*\*|(?<!:)//(.*?)(?<!:)//|__(.*?)__|~~(.*?)~~|''(.*?)''"
+                           r"|\[\[(?:[^|\]]*\|)?(.*?)\]\]|[_^]\{(.*?)\}")
+STRIP_KEEP    = r'\1\2\3\4\5\6\7'
+STRIP_CHARS   = frozenset("*/_~'[^")
+
+# Zim tables: `|a|b|` rows, with `|---|:--:|` under the header
+# the indent of a bullet decides if it is under the one above
+INDENT_PATTERN = re.compile('[ \t]*')
+
+TABLE_SEPARATOR    = '|'
+TABLE_ESCAPE       = '\\'
+TABLE_PADDING      = ' \t'
+TABLE_ROW_PATTERN  = re.compile(r'[ \t]*\|.*\|[ \t]*$')
+TABLE_RULE_PATTERN = re.compile(r'[ \t]*\|(?:[ \t]*:?-+:?[ \t]*\|)+[ \t]*$')
+
+# the languages found by `locale -a` are kept here, with what they depend on
+CATALOG_FOLDER = 'field_sort'
+CATALOG_NAME   = 'languages.json'
+CATALOG_STAMP_PATHS = (
+    '/usr/lib/locale',
+    '/usr/lib/locale/locale-archive',
+    '/usr/share/i18n/SUPPORTED',
+)
+
+# the key of the sortkeys in a saved SortPlan
+PLAN_SORTKEYS = 'sortkeys'
+
+# the daemon listens here; field_sort_client.py must agree
+SOCKET_ENVIRONMENT = 'FIELD_SORT_SOCKET'
+SOCKET_NAME        = 'field_sort-{}.sock'
+SOCKET_FOLDER      = 'field_sort-{}'   # the user's own, in /tmp
+
+# a count is put after any Zim bullet, number, checkbox or table `|`
+BULLET_PATTERN = re.compile(r'^(\s*(?:(?:[*\u2022]|\[[ *x<>]\]|\d+\.|[a-zA-Z]\.)\s+|\|))?')
+
+# number of lines KeyBuilder does before checking if it should stop
+KEY_BUILDER_CHUNK = 1000
+
+# largest value for `Only the first:`
+TOP_MAXIMUM = 1000000
+
+# merge the sorted runs instead of a full sort if there are no more than this
+MERGE_RUNS_LIMIT = 8
+
+# build the columns of the sortkeys in threads for at least this many lines,
+# on a Python without the GIL
+PARALLEL_MINIMUM = 50000
+
+# after the dialog, show the progress of sorts of at least this many lines
+PROGRESS_MINIMUM  = 20000
+PROGRESS_INTERVAL = 100   # milliseconds between updates
+
 NUMBER_OF_COLUMNS  = 5
-CONTROLS_START_ROW = 2
 
+LEVELS_HEIGHT = 150  # of the list of sortkeys
+
+# the dialog starts with a sortkey for each field, 1 up to this many
+DEFAULT_LEVELS = 6
+
+# the preview in the dialog shows this many of the sorted lines
+PREVIEW_LINES  = 10
+PREVIEW_HEIGHT = 150
+
+# columns of the list of sortkeys
 ENABLE_COLUMN     = 0
 SORT_ON_COLUMN    = 1
 SORT_AS_COLUMN    = 2
 SORT_ORDER_COLUMN = 3
 LANGUAGE_COLUMN   = 4
 
+# columns of the choices of a combo
+CHOICE_ID   = 0
+CHOICE_TEXT = 1
+
 NARROW_MARGIN = 0
 SIDE_MARGIN   = 5
 WIDE_MARGIN   = 5
@@ -79,13 +181,13 @@ WIDE_MARGIN   = 5
 # --------------------------------------
 # translatable strings
 STRING_TITLE = _('Field Sort - Zim Desktop Wiki')
+STRING_SORTING = _('Sorting...')
 
 STRING_MSG  = _('No field selected')
 STRING_MSG2 = _('No field has been select. This will cancel the sort. Do you wish to cancel?')
 
 STRING_NONE  = _('None')
 STRING_SORT_ON     = _('Sort on:')
-STRING_THEN_ON     = _('Then on:')
 STRING_ENTIRE_LINE = _('entire line')
 STRING_SORT_AS     = _('Sort as:')
 STRING_ORDER       = _('Order:')
@@ -94,7 +196,49 @@ STRING_LANGUAGE    = _('Language:')
 STRING_SORT_BY_FIELDS   = _('Sort by fields')
 STRING_NO_FIELDS_FOUND  = _('No fields found')
 STRING_NUMBER_OF_FIELDS = _('Number of fields: ')
-STRING_SORT_BY_LINES    = _('Sort by lines')
+STRING_ADD_LEVEL        = _('Add')
+STRING_REMOVE_LEVEL     = _('Remove')
+STRING_OPTIONS          = _('Options')
+STRING_TOP              = _('Only the first:')
+STRING_REST             = _('The others:')
+STRING_UNIQUE           = _('Remove duplicates')
+STRING_COUNT            = _('Count duplicates')
+STRING_PREVIEW          = _('Preview')
+
+STRING_DESCRIPTION = _('Sort Zim Desktop Wiki lines by marked fields.')
+STRING_HELP_KEY    = _('sort on FIELD[:SORT_AS[:ORDER[:LANGUAGE]]]; '
+                       'FIELD is a field number or "line"; may be repeated; '
+                       'skips the dialog')
+STRING_HELP_CHECK  = _('only check if the lines are sorted; '
+                       'the selection is not changed')
+STRING_HELP_TOP    = _('only sort the first N lines; 0 sorts all of them')
+STRING_HELP_REST   = _('what to do with the lines after the first N: '
+                       '"drop" them or "append" them unsorted')
+STRING_HELP_UNIQUE = _('keep only the first of the lines that have equal sortkeys')
+STRING_HELP_COUNT  = _('like --unique but put the number of duplicates in front of each line')
+STRING_HELP_DAEMON = _('keep running and sort for field_sort_client.py')
+STRING_HELP_MARKUP = _('what marks the fields: a comma-separated list of '
+                       '"mark", "bold", "italic", "strike" and "verbatim"; default "mark"')
+STRING_HELP_RECORDS = _('sort "bullets" with the lines indented under them, '
+                        'or "paragraphs" separated by blank lines, as a whole; '
+                        'the fields are taken from their first line')
+STRING_HELP_PLAN   = _('sort with the sortkeys saved in FILE by --save-plan; skips the dialog')
+STRING_HELP_SAVE   = _('save the sortkeys used in FILE, for --plan')
+STRING_HELP_MEMORY = _('write how much memory each stage of the sort uses to the standard error')
+STRING_HELP_INSERT = _('the lines are sorted but for some added after them; '
+                       'put those in their places')
+STRING_MEMORY      = _('memory')
+STRING_PEAK        = _('peak')
+STRING_RETAINED    = _('retained')
+STRING_PER_LINE    = _('peak/line')
+STRING_BAD_KEY     = _('invalid sortkey: ')
+STRING_BAD_PLAN    = _('cannot read plan: ')
+STRING_EMPTY_PLAN  = _('no sortkeys')
+STRING_NOT_SAVED   = _('cannot save plan: ')
+STRING_BAD_MARKUP  = _('invalid markup: ')
+STRING_DISORDER    = _('disorder at line ')
+STRING_RUNNING     = _('a daemon is already running on ')
+STRING_UNSAFE      = _('others could change the socket or its folder: ')
 
 # consolidated strings for 'Sort as:'
 STRING_TEXT      = _('Text')
@@ -108,6 +252,10 @@ STRING_VERSION   = _('Version')  # period is separator, not decimal point
 STRING_ASCENDING  = _('Ascending')
 STRING_DESCENDING = _('Descending')
 
+# consolidated strings for 'The others:'
+STRING_DROP   = _('Drop')
+STRING_APPEND = _('Append unsorted')
+
 # --------------------------------------
 # Theses strings are NOT to be translated
 ID_TEXT   = 'text'
@@ -118,7 +266,22 @@ ID_DESCENDING = 'descending'
 
 ID_NONE = 'none'
 
+ID_DROP   = 'drop'
+ID_APPEND = 'append'
+
+ID_MARK     = 'mark'
+ID_BOLD     = 'bold'
+ID_ITALIC   = 'italic'
+ID_STRIKE   = 'strike'
+ID_VERBATIM = 'verbatim'
+
+MARKUP_SEPARATOR = ','
+
+ID_BULLETS    = 'bullets'
+ID_PARAGRAPHS = 'paragraphs'
+
 ID_ENTIRE_LINE = -1
+ID_LINE        = 'line'
 
 Sort_as_list = {
     ID_TEXT: STRING_TEXT,
@@ -130,6 +293,26 @@ Sort_order_list = {
     ID_DESCENDING: STRING_DESCENDING,
 }
 
+Rest_list = {
+    ID_DROP:   STRING_DROP,
+    ID_APPEND: STRING_APPEND,
+}
+
+# the Zim markups that can mark fields, and their doubled character
+Markup_list = {
+    ID_MARK:     '_',
+    ID_BOLD:     '*',
+    ID_ITALIC:   '/',
+    ID_STRIKE:   '~',
+    ID_VERBATIM: "'",
+}
+
+# what must not come before a field's opening or closing markup:
+# the `//` of a URL is not italic
+Markup_guards = {
+    ID_ITALIC:   '(?<!:)',
+}
+
 # --------------------------------------
 # Globals
 
@@ -143,6 +326,15 @@ AppLocale   = None
 AppEncoding = None
 AppLanguage = None
 
+# set when the other languages have been added to Language_list
+CatalogLoaded = False
+
+# the Language of each language used, by name
+Language_cache = {}
+
+# held while the locale of the process is used or changed
+LocaleLock = threading.RLock()
+
 
 # --------------------------------------
 # Subroutines
@@ -161,6 +353,7 @@ def load_languages():
     # Load the app's locale data from its environment.
     # Note the 2nd call will not do anything if the 1st did.
     # That is, the 2nd call does nothing if the 1st worked.
+    # This is the only time LC_NUMERIC is set; see number_conventions().
     locale.setlocale(locale.LC_ALL, '')    # use user's default settings
     locale.setlocale(locale.LC_ALL, None)  # use current setting
     AppLocale, AppEncoding = locale.getlocale()
@@ -173,123 +366,847 @@ def load_languages():
 
 
 # --------------------------------------
-def read_text():
+def default_language():
+    '''
+          Name: default_language
+         Usage: language = default_language()
+       Purpose: The language a new sortkey starts with: the user's,
+                or ID_NONE if the locale has none.
+    Parameters: (none)
+       Returns: language -- AppLanguage or ID_NONE
+    '''
+    if AppLanguage is None:
+        return ID_NONE
+    return AppLanguage
+
+
+# --------------------------------------
+def catalog_stamp():
+    '''
+          Name: catalog_stamp
+         Usage: stamp = catalog_stamp()
+       Purpose: Describe what the list of languages depends on, so
+                that the catalog is made again when it changes.
+    Parameters: (none)
+       Returns: stamp -- list that can be saved as JSON
+    '''
+    stamp = []
+    for path in CATALOG_STAMP_PATHS:
+        try:
+            status = os.stat(path)
+            stamp.append([path, status.st_mtime_ns, status.st_size])
+        except OSError:
+            pass
+
+    try:
+        import icu
+        stamp.append(['icu', icu.ICU_VERSION])
+    except ImportError:
+        pass
+
+    return stamp
+
+
+# --------------------------------------
+def discover_languages():
+    '''
+          Name: discover_languages
+         Usage: languages = discover_languages()
+       Purpose: Ask the system which locales it has. This is slow,
+                so it is done only when the catalog is out of date.
+    Parameters: (none)
+       Returns: languages -- list of locale names
+    '''
+    try:
+        found = subprocess.run(['locale', '-a'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    # not checked with setlocale(); KeyBuilder may be using the locale
+    languages = found.stdout.split()
+    return languages
+
+
+# --------------------------------------
+def load_catalog():
+    '''
+          Name: load_catalog
+         Usage: load_catalog()
+       Purpose: Add the languages of the system to Language_list,
+                from the cache file if it is still good. Only done
+                once, when needed, so that startup does not pay for it.
+    Parameters: (none)
+       Returns: (none)
+    '''
+    global CatalogLoaded
+
+    if CatalogLoaded:
+        return
+    CatalogLoaded = True
+
+    folder = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                          CATALOG_FOLDER)
+    path   = os.path.join(folder, CATALOG_NAME)
+    stamp  = catalog_stamp()
+
+    languages = None
+    try:
+        with open(path) as cache:
+            catalog = json.load(cache)
+        if catalog['stamp'] == stamp:
+            languages = catalog['languages']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    if languages is None:
+        languages = discover_languages()
+        try:
+            os.makedirs(folder, exist_ok=True)
+            temporary = path + '.' + str(os.getpid())
+            with open(temporary, 'w') as cache:
+                json.dump({'stamp': stamp, 'languages': languages}, cache)
+            os.replace(temporary, path)
+        except OSError:
+            pass   # no cache, it will be slow next time too
+
+    for language in languages:
+        if language not in Language_list:
+            Language_list[language] = language
+
+    return
+
+
+# --------------------------------------
+class Language:
+    '''
+          Name: Language
+         Usage: language = language_for(name)
+       Purpose: How a language writes numbers and orders text, found
+                once and never changed after, so that any number of
+                threads can use it at once without changing the locale
+                of the process. Text is collated by ICU if PyICU is
+                installed. Otherwise the C library collates it, which
+                needs the locale set, so that is done for one column at
+                a time under LocaleLock; the user's language, set at
+                startup, is collated without changing it.
+    Parameters: name     -- a language, e.g. de_DE.UTF-8
+       Returns: language -- .name, .decimal_point, .thousands_sep and
+                            .collator, the ICU collator or None
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.decimal_point, self.thousands_sep = number_conventions(name)
+
+        try:
+            import icu
+            self.collator = icu.Collator.createInstance(icu.Locale(name.split('.')[0]))
+        except ImportError:
+            self.collator = None
+
+
+    # ----------------------------------
+    def number(self, value):
+        '''
+              Name: number
+             Usage: sort_value = language.number(value)
+           Purpose: Convert a field to a number, if it is one, as
+                    locale.delocalize() does but without the locale.
+        Parameters: value      -- the field
+           Returns: sort_value -- float, or value as is
+        '''
+        number = value
+        if self.thousands_sep:
+            number = number.replace(self.thousands_sep, EMPTY_STRING)
+        if self.decimal_point:
+            number = number.replace(self.decimal_point, '.')
+        try:
+            return float(number)
+        except ValueError:
+            return value
+
+
+    # ----------------------------------
+    def numbers(self, values):
+        '''
+              Name: numbers
+             Usage: sort_values = language.numbers(values)
+           Purpose: Convert many fields to numbers.
+        Parameters: values      -- list of fields
+           Returns: sort_values -- list of floats, or fields as is
+        '''
+        return list(map(self.number, values))
+
+
+    # ----------------------------------
+    def collate(self, values):
+        '''
+              Name: collate
+             Usage: sort_values = language.collate(values)
+           Purpose: Convert many fields to their collation keys, which
+                    compare as the language orders the fields.
+        Parameters: values      -- list of fields
+           Returns: sort_values -- list of collation keys
+        '''
+        if self.collator is not None:
+            return list(map(self.collator.getSortKey, values))
+
+        with LocaleLock:
+            if self.name == AppLanguage:
+                return list(map(locale.strxfrm, values))
+
+            saved = locale.setlocale(locale.LC_COLLATE)
+            locale.setlocale(locale.LC_COLLATE, self.name)
+            try:
+                return list(map(locale.strxfrm, values))
+            finally:
+                locale.setlocale(locale.LC_COLLATE, saved)
+
+
+# --------------------------------------
+def number_conventions(name):
+    '''
+          Name: number_conventions
+         Usage: decimal_point, thousands_sep = number_conventions(name)
+       Purpose: Find how a language writes numbers without changing
+                the locale of the process, which the GTK loop and
+                KeyBuilder are using. LC_NUMERIC is set once, at
+                startup, to the user's language; another language is
+                asked of ICU, or of the `locale` command run in it.
+                Only if neither can tell is the locale changed, under
+                LocaleLock.
+    Parameters: name          -- a language, e.g. de_DE.UTF-8
+       Returns: decimal_point -- e.g. ','
+                thousands_sep -- e.g. '.'; may be empty
+    '''
+    if name == AppLanguage:
+        with LocaleLock:
+            conventions = locale.localeconv()
+        return conventions['decimal_point'], conventions['thousands_sep']
+
+    try:
+        import icu
+        symbols = icu.DecimalFormatSymbols(icu.Locale(name.split('.')[0]))
+        return (symbols.getSymbol(icu.DecimalFormatSymbols.kDecimalSeparatorSymbol),
+                symbols.getSymbol(icu.DecimalFormatSymbols.kGroupingSeparatorSymbol))
+    except ImportError:
+        pass
+
+    # the command says on stderr if it does not have the language
+    environment = dict(os.environ, LC_ALL=name)
+    try:
+        found = subprocess.run(['locale', '-k', 'decimal_point', 'thousands_sep'], env=environment,
+                               capture_output=True, text=True, errors='replace')
+        if found.returncode == 0 and not found.stderr:
+            conventions = dict(line.split('=', 1) for line in found.stdout.splitlines() if '=' in line)
+            return (conventions['decimal_point'].strip('"'),
+                    conventions['thousands_sep'].strip('"'))
+    except (OSError, KeyError):
+        pass
+
+    with LocaleLock:
+        saved = locale.setlocale(locale.LC_NUMERIC)
+        locale.setlocale(locale.LC_NUMERIC, name)
+        try:
+            conventions = locale.localeconv()
+        finally:
+            locale.setlocale(locale.LC_NUMERIC, saved)
+    return conventions['decimal_point'], conventions['thousands_sep']
+
+
+# --------------------------------------
+def gil_enabled():
+    '''
+          Name: gil_enabled
+         Usage: if gil_enabled(): ...
+       Purpose: Check if Python runs only one thread at a time.
+    Parameters: (none)
+       Returns: True unless Python is a free-threaded build
+    '''
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is None or is_gil_enabled()
+
+
+# --------------------------------------
+def language_for(name):
+    '''
+          Name: language_for
+         Usage: language = language_for(name)
+       Purpose: Get the Language of a name, made the first time only.
+    Parameters: name     -- a language, not ID_NONE or None
+       Returns: language -- Language
+    '''
+    language = Language_cache.get(name)
+    if language is None:
+        with LocaleLock:
+            language = Language_cache.get(name)
+            if language is None:
+                language = Language(name)
+                Language_cache[name] = language
+    return language
+
+
+# --------------------------------------
+def parse_sortkey(spec):
+    '''
+          Name: parse_sortkey
+         Usage: sortkey = parse_sortkey(spec)
+       Purpose: Convert a sortkey given on the command-line into the
+                same tuple as SortkeyDialog.get_sortkeys() creates.
+    Parameters: spec    -- FIELD[:SORT_AS[:ORDER[:LANGUAGE]]]
+       Returns: sortkey -- (field#,sort_as,order,language)
+    '''
+    parts = spec.split(KEY_SEPARATOR)
+    if len(parts) > 4:
+        raise argparse.ArgumentTypeError(STRING_BAD_KEY + spec)
+
+    parts += [ID_TEXT, ID_ASCENDING, default_language()][len(parts)-1:]
+    if parts[0] == ID_LINE:
+        parts[0] = str(ID_ENTIRE_LINE)
+    elif parts[0] == str(ID_ENTIRE_LINE):
+        raise argparse.ArgumentTypeError(STRING_BAD_KEY + spec)
+
+    return check_sortkey(parts, spec)
+
+
+# --------------------------------------
+def check_sortkey(sortkey, spec):
+    '''
+          Name: check_sortkey
+         Usage: sortkey = check_sortkey(sortkey, spec)
+       Purpose: Check a sortkey from the command-line or from a plan:
+                a field number, or the entire line, and the sort as,
+                order and language that the dialog can choose.
+    Parameters: sortkey -- [field#,sort_as,order,language]
+                spec    -- what it was given as, for the error
+       Returns: sortkey -- (field#,sort_as,order,language)
+    '''
+    if not isinstance(sortkey, (list, tuple)) or len(sortkey) != 4 \
+    or not all(type(part) is str for part in sortkey):
+        raise argparse.ArgumentTypeError(STRING_BAD_KEY + spec)
+    sort_on, sort_as, sort_order, sort_lang = sortkey
+
+    if sort_on != str(ID_ENTIRE_LINE) and (not sort_on.isdigit() or int(sort_on) < 1):
+        raise argparse.ArgumentTypeError(STRING_BAD_KEY + spec)
+    if sort_lang not in Language_list:
+        load_catalog()
+    if sort_as not in Sort_as_list \
+    or sort_order not in Sort_order_list \
+    or sort_lang not in Language_list:
+        raise argparse.ArgumentTypeError(STRING_BAD_KEY + spec)
+
+    return (sort_on, sort_as, sort_order, sort_lang)
+
+
+# --------------------------------------
+def load_plan(path):
+    '''
+          Name: load_plan
+         Usage: plan = load_plan(path)
+       Purpose: Load a plan saved by --save-plan, for --plan.
+    Parameters: path -- of the file
+       Returns: plan -- SortPlan
+    '''
+    try:
+        with open(path) as saved:
+            return SortPlan.from_json(saved.read())
+    except (OSError, ValueError, KeyError, TypeError, argparse.ArgumentTypeError) as error:
+        raise argparse.ArgumentTypeError(STRING_BAD_PLAN + str(error))
+
+
+# --------------------------------------
+def parse_markup(spec):
+    '''
+          Name: parse_markup
+         Usage: kinds = parse_markup(spec)
+       Purpose: Convert the markups given on the command-line.
+    Parameters: spec  -- KIND[,KIND...]
+       Returns: kinds -- tuple of the kinds of markup
+    '''
+    kinds = tuple(spec.split(MARKUP_SEPARATOR))
+    for kind in kinds:
+        if kind not in Markup_list:
+            raise argparse.ArgumentTypeError(STRING_BAD_MARKUP + spec)
+    return kinds
+
+
+# --------------------------------------
+def read_options(args=None):
+    '''
+          Name: read_options
+         Usage: options = read_options(args)
+       Purpose: Get the options from the command-line. Options must
+                come before the selections and be written as `--name`
+                or `--name=value` so that a selection can never be
+                mistaken for an option. A `--` ends the options.
+    Parameters: args    -- optional, default is the command-line
+       Returns: options -- the options; options.selections has the
+                           remaining command-line arguments
+    '''
+    if args is None:
+        args = sys.argv[1:]
+    idx = 0
+    while idx < len(args):
+        if args[idx] == OPTION_TERMINATOR:
+            break
+        if not args[idx].startswith(OPTION_PREFIX) or '\n' in args[idx]:
+            break
+        idx += 1
+
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s [--option[=value] ...] -- %%T [%%t]',
+        description=STRING_DESCRIPTION,
+    )
+    parser.add_argument('--key', action='append', default=[],
+                        type=parse_sortkey, metavar='FIELD', help=STRING_HELP_KEY)
+    parser.add_argument('--plan', type=load_plan, metavar='FILE', help=STRING_HELP_PLAN)
+    parser.add_argument('--save-plan', metavar='FILE', help=STRING_HELP_SAVE)
+    parser.add_argument('--check', action='store_true', help=STRING_HELP_CHECK)
+    parser.add_argument('--top', type=int, default=0, metavar='N', help=STRING_HELP_TOP)
+    parser.add_argument('--rest', choices=tuple(Rest_list), default=ID_DROP,
+                        help=STRING_HELP_REST)
+    parser.add_argument('--daemon', action='store_true', help=STRING_HELP_DAEMON)
+    parser.add_argument('--markup', type=parse_markup, default=(ID_MARK,),
+                        metavar='KIND', help=STRING_HELP_MARKUP)
+    parser.add_argument('--records', choices=(ID_BULLETS, ID_PARAGRAPHS),
+                        help=STRING_HELP_RECORDS)
+    parser.add_argument('--unique', action='store_true', help=STRING_HELP_UNIQUE)
+    parser.add_argument('--count', action='store_true', help=STRING_HELP_COUNT)
+    parser.add_argument('--memory', action='store_true', help=STRING_HELP_MEMORY)
+    parser.add_argument('--insert', action='store_true', help=STRING_HELP_INSERT)
+    options = parser.parse_args(args[:idx])
+
+    if idx < len(args) and args[idx] == OPTION_TERMINATOR:
+        idx += 1
+    options.selections = args[idx:]
+
+    return options
+
+
+# --------------------------------------
+def guess_selection(args):
+    '''
+          Name: guess_selection
+         Usage: marked = guess_selection(args)
+       Purpose: Find the selection in the command-line when the
+                options could not be read, so that it can be given
+                back to Zim unchanged. It is the first argument after
+                the `--`; without one, it is the last argument, or
+                the one before it if that is followed by its %t.
+    Parameters: args   -- the command-line arguments
+       Returns: marked -- the selection; empty if there is none
+    '''
+    if OPTION_TERMINATOR in args:
+        args = args[args.index(OPTION_TERMINATOR)+1:]
+        if args:
+            return args[0]
+        return EMPTY_STRING
+
+    if len(args) >= 2 and unmark(args[-2]) == args[-1]:
+        return args[-2]
+    if args:
+        return args[-1]
+    return EMPTY_STRING
+
+
+# --------------------------------------
+def read_text(options):
     '''
           Name: read_text
-         Usage: text, marked = read_text()
+         Usage: text, marked = read_text(options)
        Purpose: Get the text from the command-line.
-    Parameters: (none)
-       Returns: text   -- from command-line argument
-                marked -- text with Zim wiki mark-ups
+    Parameters: options -- from read_options()
+       Returns: text    -- from command-line argument; None if only
+                           %T was given
+                marked  -- text with Zim wiki mark-ups
     '''
     # text is the unmarked selection. It is used for entire line sorts.
-    # This tool must be called `**/field_sort.py %T %t`
-    marked = sys.argv[1]
-    text   = sys.argv[2]
+    # This tool is called `**/field_sort.py -- %T`; `%T %t` still works
+    marked = options.selections[0]
+    text   = None
+    if len(options.selections) > 1:
+        text = options.selections[1]
     return text, marked
 
 
 # --------------------------------------
-def get_newline(marked):
+class Lines:
     '''
-          Name: get_newline
-         Usage: frontage, newline, ending = get_newline(marked)
-       Purpose: Preserve any multi-line spacing by extracting the
-                newline from the first line in text. Also save any
-                trailing newline of the text.
-    Parameters: marked  -- many lines in one string
-       Returns: frontage -- possible newlines ate front of text
-                newline  -- may have blank lines
-                ending   -- possible newline at end of text
+          Name: Lines
+         Usage: lines = Lines(text, starts, ends)
+       Purpose: The lines of a text, kept as where each starts and
+                ends in the text, found in one pass over it. A str is
+                made for a line only when it is needed. What is in
+                front of, between and after the lines stays in the
+                text, so blank lines are kept.
+    Parameters: text   -- many lines in one string
+                starts -- optional, array('q') of where the lines
+                          start, if already known
+                ends   -- optional, array('q') of where they end
+       Returns: lines  -- .text, .starts and .ends
     '''
-    # Why do it this way? Why not use splitlines()?
-    # Consider the following:
-    #    '\n'.join(sorted('x\n\ny\n\na'.splitlines()))
-    # gives: '\n\na\nx\ny'
-    # and ''.join(sorted('x\n\ny\n\na'.splitlines(keepends=True)))
-    # gives: '\n\nax\ny\n'
-    # Neither is what the user expects.
-    #
-    # There are two problems.
-    # The first is that the selection may not have a final newline.
-    # The second is the lines to sort may be separated by a blank line.
-    # The code before solves these problems, for most cases.
-    #
+    def __init__(self, text, starts=None, ends=None):
+        # Why do it this way? Why not use splitlines()?
+        # Consider the following:
+        #    '\n'.join(sorted('x\n\ny\n\na'.splitlines()))
+        # gives: '\n\na\nx\ny'
+        # and ''.join(sorted('x\n\ny\n\na'.splitlines(keepends=True)))
+        # gives: '\n\nax\ny\n'
+        # Neither is what the user expects.
+        #
+        # There are two problems.
+        # The first is that the selection may not have a final newline.
+        # The second is the lines to sort may be separated by a blank line.
+        # The code below solves these problems, for most cases.
+        #
+        self.text   = text
+        if starts is not None:
+            self.starts = starts
+            self.ends   = ends
+            return
+
+        self.starts = array.array('q')
+        self.ends   = array.array('q')
+
+        start = 0
+        stop  = len(text)
+        for found in NEWLINES_PATTERN.finditer(text):
+            if found.start() == 0:
+                pass   # newlines in front
+            elif found.end() == len(text):
+                stop = found.start()   # newlines at the end
+                break
+            else:
+                self.starts.append(start)
+                self.ends.append(found.start())
+            start = found.end()
+        self.starts.append(start)
+        self.ends.append(stop)
+
+
+    # ----------------------------------
+    def __len__(self):
+        return len(self.starts)
+
 
-    frontage = EMPTY_STRING
-    found = re.search('^((?:\r?\n)+)', marked)
-    if found:
-        frontage = found.group(1)
-    marked = re.sub('^(?:\r?\n)+', EMPTY_STRING, marked)   # remove leading blank lines, if any
+    # ----------------------------------
+    def line(self, idx):
+        '''
+              Name: line
+             Usage: line = lines.line(idx)
+           Purpose: Get a line.
+        Parameters: idx  -- index of the line
+           Returns: line -- without newlines
+        '''
+        return self.text[self.starts[idx]:self.ends[idx]]
+
+
+    # ----------------------------------
+    def line_number(self, idx):
+        '''
+              Name: line_number
+             Usage: number = lines.line_number(idx)
+           Purpose: Find where a line is in the text, counting blank
+                    lines too.
+        Parameters: idx    -- index of the line
+           Returns: number -- line number, starting at 1
+        '''
+        return self.text.count('\n', 0, self.starts[idx]) + 1
 
-    ending = EMPTY_STRING
-    found = re.search('((?:\r?\n)+)$', marked)
-    if found:
-        ending = found.group(1)
-    marked = re.sub('(?:\r?\n)+$', EMPTY_STRING, marked)   # remove trailing blank lines, if any
 
-    newline = EMPTY_STRING
-    found = re.search('((?:\r?\n)+)', marked)
-    if found:
-        newline = found.group(1)
+    # ----------------------------------
+    def join(self, order, replaced=None, progress=None):
+        '''
+              Name: join
+             Usage: text = lines.join(order, replaced, progress)
+           Purpose: Make the text again with the lines in a new order.
+                    What is between the lines stays where it was.
+        Parameters: order    -- indexes of the lines, may be fewer
+                    replaced -- optional, {index:line,...} to use in
+                                place of some lines
+                    progress -- optional, Progress; checked every chunk
+           Returns: text     -- many lines in one string
+        '''
+        if replaced is None:
+            replaced = {}
+
+        text   = self.text
+        starts = self.starts
+        ends   = self.ends
+
+        pieces = [text[:starts[0]]]
+        for pos in range(0, len(order)):
+            if progress is not None and pos % KEY_BUILDER_CHUNK == 0:
+                progress.check(pos / len(order))
+            if pos > 0:
+                pieces.append(text[ends[pos-1]:starts[pos]])
+            idx = order[pos]
+            if idx in replaced:
+                pieces.append(replaced[idx])
+            else:
+                pieces.append(text[starts[idx]:ends[idx]])
+        pieces.append(text[ends[-1]:])
 
-    return frontage, newline, ending
+        return EMPTY_STRING.join(pieces)
 
 
 # --------------------------------------
-def get_lines(text):
+def group_records(lines, kind):
     '''
-          Name: get_lines
-         Usage: lines = get_lines(text)
-       Purpose: Extract the lines from the text.
-    Parameters: (none)
-       Returns: (none)
+          Name: group_records
+         Usage: records, heads = group_records(lines, kind)
+       Purpose: Group the lines into records that are sorted as a
+                whole, in one pass over the lines. A bullet record is
+                a line and the lines under it that are indented more
+                than the first line. A paragraph record is the lines
+                between blank lines.
+    Parameters: lines   -- Lines
+                kind    -- ID_BULLETS or ID_PARAGRAPHS
+       Returns: records -- Lines whose lines are the whole records
+                heads   -- Lines of the first line of each record,
+                           which has the fields
+    '''
+    text   = lines.text
+    starts = lines.starts
+    ends   = lines.ends
+
+    firsts = array.array('q')   # index of the first line of each record
+    base = INDENT_PATTERN.match(text, starts[0], ends[0]).end() - starts[0]
+    for idx in range(0, len(lines)):
+        if idx == 0:
+            firsts.append(idx)
+        elif kind == ID_PARAGRAPHS:
+            if text.count('\n', ends[idx-1], starts[idx]) > 1:
+                firsts.append(idx)
+        elif INDENT_PATTERN.match(text, starts[idx], ends[idx]).end() - starts[idx] <= base:
+            firsts.append(idx)
+
+    record_starts = array.array('q')
+    record_ends   = array.array('q')
+    head_ends     = array.array('q')
+    for pos in range(0, len(firsts)):
+        if pos+1 < len(firsts):
+            last = firsts[pos+1] - 1
+        else:
+            last = len(lines) - 1
+        record_starts.append(starts[firsts[pos]])
+        record_ends.append(ends[last])
+        head_ends.append(ends[firsts[pos]])
+
+    records = Lines(text, record_starts, record_ends)
+    heads   = Lines(text, record_starts, head_ends)
+    return records, heads
+
+
+# --------------------------------------
+class Fields:
+    '''
+          Name: Fields
+         Usage: fields = Fields(marked, unmarked)
+       Purpose: Where the fields of each line are in the marked text.
+                Like Lines, the offsets are kept, not strings.
+    Parameters: marked   -- Lines of the Zim marked text
+                unmarked -- Lines of the unmarked text, or None to
+                            remove the markup from a marked line when
+                            the entire line is wanted
+       Returns: fields   -- .count, .starts, .ends and .first; the
+                            fields of line idx are first[idx] up to
+                            first[idx+1] in starts and ends
+    '''
+    def __init__(self, marked, unmarked):
+        self.marked   = marked
+        self.unmarked = unmarked
+        self.count    = 0
+        self.starts   = array.array('q')
+        self.ends     = array.array('q')
+        self.first    = array.array('q', [0])
+        self.head     = 0   # lines at the top that are not sorted
+
+
+    # ----------------------------------
+    def __len__(self):
+        return len(self.first) - 1
+
+
+    # ----------------------------------
+    def column(self, column, start=0, end=None):
+        '''
+              Name: column
+             Usage: values = fields.column(column, start, end)
+           Purpose: Get a field of many lines.
+        Parameters: column -- field number or ID_ENTIRE_LINE
+                    start  -- optional, first line
+                    end    -- optional, stop before this line
+           Returns: values -- list of fields; empty if missing
+        '''
+        if end is None or end > len(self):
+            end = len(self)
+
+        if column == ID_ENTIRE_LINE:
+            lines  = self.unmarked
+            if lines is None:
+                lines = self.marked
+            text   = lines.text
+            starts = lines.starts
+            ends   = lines.ends
+            values = [text[starts[idx]:ends[idx]] for idx in range(self.head+start, self.head+end)]
+            if self.unmarked is None:
+                values = list(map(unmark, values))
+            return values
+
+        text   = self.marked.text
+        starts = self.starts
+        ends   = self.ends
+        first  = self.first
+        values = []
+        for idx in range(start, end):
+            # check for missing fields
+            pos = first[idx] + column - 1
+            if column < 1 or pos >= first[idx+1]:
+                values.append(EMPTY_STRING)
+            else:
+                values.append(text[starts[pos]:ends[pos]])
+        return values
+
+
+# --------------------------------------
+@functools.lru_cache()
+def field_pattern(kinds):
+    '''
+          Name: field_pattern
+         Usage: pattern = field_pattern(kinds)
+       Purpose: Compile one pattern that finds the fields of every
+                kind of markup wanted, so a line is scanned only once
+                however many kinds there are. Kept for next time.
+    Parameters: kinds   -- tuple of the kinds of markup
+       Returns: pattern -- compiled; the name of the group that
+                           matched is the kind
+    '''
+    alternatives = []
+    for kind in kinds:
+        alternatives.append(FIELD_TEMPLATE.format(kind=kind, c=re.escape(Markup_list[kind]),
+                                                  guard=Markup_guards.get(kind, EMPTY_STRING)))
+    return re.compile('|'.join(alternatives), re.DOTALL)
+
+
+# --------------------------------------
+def unmark(marked):
     '''
-    # splitlines() does not handle blank lines between the lines to sort.
-    # This code does.
-    text = re.sub('^(?:\r?\n)+', EMPTY_STRING, text)   # remove leading newline, if any
-    text = re.sub('(?:\r?\n)+$', EMPTY_STRING, text)   # remove trailing newline, if any
-    lines = re.split('(?:\r?\n)+', text)
-    return lines
+          Name: unmark
+         Usage: text = unmark(marked)
+       Purpose: Remove the Zim markup from a line, as Zim does for
+                %t. Most lines have none, and are returned at once.
+    Parameters: marked -- Zim marked text
+       Returns: text   -- the unmarked text
+    '''
+    if STRIP_CHARS.isdisjoint(marked):
+        return marked
+
+    # markup inside markup, like **__bold mark__**
+    text, found = STRIP_PATTERN.subn(STRIP_KEEP, marked)
+    while found:
+        text, found = STRIP_PATTERN.subn(STRIP_KEEP, text)
+    return text
 
 
 # --------------------------------------
-def get_fields(text, marked):
+def get_fields(text, marked, kinds=(ID_MARK,)):
     '''
           Name: get_fields
-         Usage: fields = get_fields(text, marked)
+         Usage: count, fields = get_fields(text, marked, kinds)
        Purpose: Extract the fields in each line. Fields are
                 determined by leading and trailing double
-                underscores. Together with the lines from both the
-                unmarked and marked text, a tuple is created with the
-                fields. This tuple is added to a tuple of tuples.
-    Parameters: text   -- lines of unmarked text
-                marked -- line of Zim marked text
+                underscores, or the other markups wanted. Only their
+                offsets are kept.
+    Parameters: text   -- Lines of unmarked text, or None
+                marked -- Lines of Zim marked text
+                kinds  -- optional, tuple of the kinds of markup
        Returns: count  -- maximum number of fields
-                fields -- a tuple of tuples
+                fields -- Fields
+    '''
+    pattern = field_pattern(kinds)
+    fields = Fields(marked, text)
+    count = 0
+    for idx in range(0, len(marked)):
+        cnt = 0
+        for found in pattern.finditer(marked.text, marked.starts[idx], marked.ends[idx]):
+            fields.starts.append(found.start()+FIELD_MARK_SIZE)
+            fields.ends.append(found.end()-FIELD_MARK_SIZE)
+            cnt += 1
+        fields.first.append(len(fields.starts))
+        if count < cnt:
+            count = cnt
+
+    fields.count = count
+    return count, fields
+
+
+# --------------------------------------
+def find_table(marked):
+    '''
+          Name: find_table
+         Usage: head = find_table(marked)
+       Purpose: Check if the selection is a Zim table and find its
+                header, which is everything down to the `|---|` row.
+    Parameters: marked -- Lines of Zim marked text
+       Returns: head   -- number of lines in the header, which may be
+                          0; None if it is not a table
     '''
-    # fields is a tuple of tuples
-    # (
-    #     (marked_line, unmarked_line, field_1, field_2, ..., ),
-    #     ...,
-    # )
+    head = 0
+    for idx in range(0, len(marked)):
+        start = marked.starts[idx]
+        end   = marked.ends[idx]
+        if not TABLE_ROW_PATTERN.match(marked.text, start, end):
+            return None
+        if head == 0 and TABLE_RULE_PATTERN.match(marked.text, start, end):
+            head = idx + 1
+    return head
 
-    zipped = zip(get_lines(marked), get_lines(text))
+
+# --------------------------------------
+def get_cells(text, marked, head):
+    '''
+          Name: get_cells
+         Usage: count, fields = get_cells(text, marked, head)
+       Purpose: Use the cells of a Zim table as its fields. The `|`s
+                are found with str.split(), not a pattern, and the
+                spaces around each cell are not part of it.
+    Parameters: text   -- Lines of unmarked text, or None
+                marked -- Lines of Zim marked text
+                head   -- from find_table()
+       Returns: count  -- maximum number of cells
+                fields -- Fields, with fields.head set to head
+    '''
+    buffer = marked.text
+    fields = Fields(marked, text)
+    fields.head = head
     count = 0
-    fields = ()
-    for item in zipped:
-        per_line = (item[0],)
-        found = re.findall('__[^_]*(?:(?:_[^_]+))*__', item[0])
+    for idx in range(head, len(marked)):
+        pieces = buffer[marked.starts[idx]:marked.ends[idx]].split(TABLE_SEPARATOR)
+
+        # the pieces between the first and last `|` are the cells,
+        # unless a `|` is escaped
+        pos   = marked.starts[idx] + len(pieces[0]) + 1
+        start = pos
         cnt = 0
-        for each in found:
-            each = re.search(r'__(.*)__', each).group(1)
-            per_line += (each, )
+        for piece in pieces[1:-1]:
+            pos += len(piece)
+            if piece.endswith(TABLE_ESCAPE):
+                pos += 1
+                continue
+
+            cell = piece
+            if start != pos - len(piece):
+                cell = buffer[start:pos]
+            fields.starts.append(start + len(cell) - len(cell.lstrip(TABLE_PADDING)))
+            fields.ends.append(pos - len(cell) + len(cell.rstrip(TABLE_PADDING)))
             cnt += 1
-        per_line += (item[1], )
-        fields += (per_line,)
+            pos += 1
+            start = pos
+        fields.first.append(len(fields.starts))
         if count < cnt:
             count = cnt
 
+    fields.count = count
     return count, fields
 
 
@@ -319,89 +1236,79 @@ def set_margins(widget, left, top=None, right=None, bottom=None):
 
 
 # --------------------------------------
-def sort_controls(grid, row, field, count):
+def choice_model(choices):
     '''
-          Name: sort_controls
-         Usage: controls = sort_controls(grid, after_row, field_number, count_of_fields)
-       Purpose: Create a set of controls for the sort and insert
-                them into the grid after the row.
-    Parameters: grid            -- where the controls will be shown
-                after_row       -- index after which the controls are
-                                   added to the grid
-                field_number    -- used as default for SpinButton
-                count_of_fields -- maximum for SpinButton
-       Returns: controls        -- controls created
+          Name: choice_model
+         Usage: model = choice_model(choices)
+       Purpose: Create the list of choices for a combo. Each model is
+                shared by every row of the sortkeys, so it is made once.
+    Parameters: choices -- {id:text,...}
+       Returns: model   -- Gtk.ListStore of (id,text)
     '''
-    controls = ()
+    model = Gtk.ListStore(str, str)
+    for item in choices.items():
+        model.append(item)
+    return model
 
-    # en-/disable control
-    if field>0 or count>0:
-        ctl = Gtk.CheckButton()
-        ctl.set_active(field>0)
-        set_margins(ctl, SIDE_MARGIN, WIDE_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
-        grid.attach(ctl, ENABLE_COLUMN, row, 1, 2)
-        controls += (ctl,)
-    else:
-        controls += (None,)
 
-    # field order
-    if row == CONTROLS_START_ROW or count == 0:
-        lbl = Gtk.Label(label=STRING_SORT_ON)
-    else:
-        lbl = Gtk.Label(label=STRING_THEN_ON)
+# --------------------------------------
+def field_choices(count):
+    '''
+          Name: field_choices
+         Usage: choices = field_choices(count)
+       Purpose: The choices for `Sort on:`.
+    Parameters: count   -- number of fields
+       Returns: choices -- {id:text,...}
+    '''
+    choices = {}
+    for idx in range(0, count):
+        choices[str(idx+1)] = str(idx+1)
+    choices[str(ID_ENTIRE_LINE)] = STRING_ENTIRE_LINE
+    return choices
+
+
+# --------------------------------------
+def option_controls(grid, row, options, total):
+    '''
+          Name: option_controls
+         Usage: controls = option_controls(grid, row, options, total)
+       Purpose: Create the controls to keep only the first lines and
+                to remove duplicates, and insert them into the grid at
+                the row.
+    Parameters: grid     -- where the controls will be shown
+                row      -- index at which the controls are added
+                options  -- from read_options(), for the initial settings
+                total    -- number of lines, maximum for SpinButton
+       Returns: controls -- (SpinButton,ComboBoxText,CheckButton,CheckButton)
+    '''
+    lbl = Gtk.Label(label=STRING_TOP)
     set_margins(lbl, SIDE_MARGIN, WIDE_MARGIN, SIDE_MARGIN, NARROW_MARGIN)
     grid.attach(lbl, SORT_ON_COLUMN, row, 1, 1)
-    if field > 0:
-        ctl = Gtk.ComboBoxText()
-        for idx in range(0, count):
-            ctl.append(str(idx+1), str(idx+1))
-        ctl.set_active(field-1)
-        set_margins(ctl, SIDE_MARGIN, NARROW_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
-        grid.attach(ctl, SORT_ON_COLUMN, row+1, 1, 1)
-        controls += (ctl,)
-    else:
-        lbl = Gtk.Label(label=STRING_ENTIRE_LINE)
-        set_margins(lbl, SIDE_MARGIN, NARROW_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
-        grid.attach(lbl, SORT_ON_COLUMN, row+1, 1, 1)
-        controls += (None,)
+    top = Gtk.SpinButton.new_with_range(0, min(total, TOP_MAXIMUM), 1)
+    top.set_value(options.top)
+    set_margins(top, SIDE_MARGIN, NARROW_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
+    grid.attach(top, SORT_ON_COLUMN, row+1, 1, 1)
 
-    # datatype
-    lbl = Gtk.Label(label=STRING_SORT_AS)
+    lbl = Gtk.Label(label=STRING_REST)
     set_margins(lbl, SIDE_MARGIN, WIDE_MARGIN, SIDE_MARGIN, NARROW_MARGIN)
     grid.attach(lbl, SORT_AS_COLUMN, row, 1, 1)
-    ctl = Gtk.ComboBoxText()
-    for item in Sort_as_list.items():
-        ctl.append(item[0],item[1])
-    ctl.set_active_id(ID_TEXT)
-    set_margins(ctl, SIDE_MARGIN, NARROW_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
-    grid.attach(ctl, SORT_AS_COLUMN, row+1, 1, 1)
-    controls += (ctl,)
-
-    # order
-    lbl = Gtk.Label(label=STRING_ORDER)
-    set_margins(lbl, SIDE_MARGIN, WIDE_MARGIN, SIDE_MARGIN, NARROW_MARGIN)
-    grid.attach(lbl, SORT_ORDER_COLUMN, row, 1, 1)
-    ctl = Gtk.ComboBoxText()
-    for item in Sort_order_list.items():
-        ctl.append(item[0],item[1])
-    ctl.set_active_id(ID_ASCENDING)
-    set_margins(ctl, SIDE_MARGIN, NARROW_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
-    grid.attach(ctl, SORT_ORDER_COLUMN, row+1, 1, 1)
-    controls += (ctl,)
-
-    # language
-    lbl = Gtk.Label(label=STRING_LANGUAGE)
-    set_margins(lbl, SIDE_MARGIN, WIDE_MARGIN, SIDE_MARGIN, NARROW_MARGIN)
-    grid.attach(lbl, LANGUAGE_COLUMN, row, 1, 1)
-    ctl = Gtk.ComboBoxText()
-    for item in Language_list.items():
-        ctl.append(item[0],item[1])
-    ctl.set_active_id(AppLanguage)
-    set_margins(ctl, SIDE_MARGIN, NARROW_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
-    grid.attach(ctl, LANGUAGE_COLUMN, row+1, 1, 1)
-    controls += (ctl,)
+    rest = Gtk.ComboBoxText()
+    for item in Rest_list.items():
+        rest.append(item[0],item[1])
+    rest.set_active_id(options.rest)
+    set_margins(rest, SIDE_MARGIN, NARROW_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
+    grid.attach(rest, SORT_AS_COLUMN, row+1, 1, 1)
 
-    return controls
+    unique = Gtk.CheckButton(label=STRING_UNIQUE)
+    unique.set_active(options.unique)
+    set_margins(unique, SIDE_MARGIN, WIDE_MARGIN, SIDE_MARGIN, NARROW_MARGIN)
+    grid.attach(unique, SORT_ORDER_COLUMN, row, 2, 1)
+    count = Gtk.CheckButton(label=STRING_COUNT)
+    count.set_active(options.count)
+    set_margins(count, SIDE_MARGIN, NARROW_MARGIN, SIDE_MARGIN, WIDE_MARGIN)
+    grid.attach(count, SORT_ORDER_COLUMN, row+1, 2, 1)
+
+    return (top, rest, unique, count)
 
 
 # --------------------------------------
@@ -426,24 +1333,29 @@ class SortkeyDialog(Gtk.Dialog):
 
 
     # ----------------------------------
-    def show_guts(self, count):
+    def show_guts(self, count, options, total, preview=None):
         '''
               Name: show_guts
-             Usage: dialog.show_guts(count)
+             Usage: dialog.show_guts(count, options, total, preview)
            Purpose: Add the controls to the dialog and show them.
                     This cannot be done in __init__() since it needs the argument `count`.
-        Parameters: count -- initial number of keys to display
+                    The sortkeys are rows of a list, so the dialog
+                    does not grow with the number of fields; it starts
+                    with the first fields, as many as DEFAULT_LEVELS,
+                    and more are added by the `Add` button.
+        Parameters: count   -- number of fields
+                    options -- from read_options(), for the initial settings
+                    total   -- number of lines
+                    preview -- optional, Preview of the lines
            Returns: (none)
         '''
+        self.count   = count
+        self.preview = preview
+        self.preview_source = None
 
         # build the guts
         content_area = self.get_content_area()
 
-        scrolled = Gtk.ScrolledWindow()
-        scrolled.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
-        scrolled.set_hexpand(True)
-        scrolled.set_vexpand(True)
-
         self.grid = Gtk.Grid()
 
         subtitle = Gtk.Label(label=STRING_SORT_BY_FIELDS)
@@ -455,85 +1367,303 @@ class SortkeyDialog(Gtk.Dialog):
             fields_count = Gtk.Label(label=STRING_NUMBER_OF_FIELDS+str(count))
         self.grid.attach(fields_count, 0, 1, NUMBER_OF_COLUMNS, 1)
 
-        self.controls = ()
-        for i in range(0, count):
-            ctls = sort_controls(self.grid, i*2+CONTROLS_START_ROW, i+1, count)
-            self.controls += (ctls,)
+        # one row per sortkey: enabled, sort on, sort as, order, language
+        self.levels = Gtk.ListStore(bool, str, str, str, str)
+        language = default_language()
+        for idx in range(0, min(count, DEFAULT_LEVELS)):
+            self.levels.append((True, str(idx+1), ID_TEXT, ID_ASCENDING, language))
+        self.levels.append((count == 0, str(ID_ENTIRE_LINE), ID_TEXT, ID_ASCENDING, language))
+
+        self.tree = Gtk.TreeView(model=self.levels)
+        self.tree.set_reorderable(True)   # drag to change the order of the sortkeys
+
+        renderer = Gtk.CellRendererToggle()
+        renderer.connect('toggled', self.on_toggled)
+        self.tree.append_column(Gtk.TreeViewColumn(EMPTY_STRING, renderer, active=ENABLE_COLUMN))
 
-        # can also sort by entire lines
-        subtitle = Gtk.Label(label=STRING_SORT_BY_LINES)
-        self.grid.attach(subtitle, 0, count*2+CONTROLS_START_ROW, NUMBER_OF_COLUMNS, 1)
-        ctls = sort_controls(self.grid, count*2+CONTROLS_START_ROW+1, ID_ENTIRE_LINE, count)
-        self.controls += (ctls,)
+        self.add_choice_column(STRING_SORT_ON,  SORT_ON_COLUMN,    field_choices(count))
+        self.add_choice_column(STRING_SORT_AS,  SORT_AS_COLUMN,    Sort_as_list)
+        self.add_choice_column(STRING_ORDER,    SORT_ORDER_COLUMN, Sort_order_list)
+        renderer = self.add_choice_column(STRING_LANGUAGE, LANGUAGE_COLUMN, Language_list)
+        renderer.connect('editing-started', self.on_languages_opened)
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+        scrolled.set_hexpand(True)
+        scrolled.set_vexpand(True)
+        scrolled.set_min_content_height(LEVELS_HEIGHT)
+        set_margins(scrolled, SIDE_MARGIN)
+        scrolled.add(self.tree)
+        self.grid.attach(scrolled, 0, 2, NUMBER_OF_COLUMNS, 1)
+
+        # add and remove sortkeys
+        add_btn = Gtk.Button(label=STRING_ADD_LEVEL)
+        add_btn.connect('clicked', self.on_add_level)
+        set_margins(add_btn, SIDE_MARGIN)
+        self.grid.attach(add_btn, SORT_ON_COLUMN, 3, 1, 1)
+        remove_btn = Gtk.Button(label=STRING_REMOVE_LEVEL)
+        remove_btn.connect('clicked', self.on_remove_level)
+        set_margins(remove_btn, SIDE_MARGIN)
+        self.grid.attach(remove_btn, SORT_AS_COLUMN, 3, 1, 1)
+
+        # can also keep only the first lines
+        subtitle = Gtk.Label(label=STRING_OPTIONS)
+        self.grid.attach(subtitle, 0, 4, NUMBER_OF_COLUMNS, 1)
+        self.option_controls = option_controls(self.grid, 5, options, total)
+
+        # the first lines, sorted as the sortkeys are now
+        if preview is not None:
+            subtitle = Gtk.Label(label=STRING_PREVIEW)
+            self.grid.attach(subtitle, 0, 7, NUMBER_OF_COLUMNS, 1)
+            self.preview_view = Gtk.TextView(editable=False, cursor_visible=False, monospace=True)
+            scrolled = Gtk.ScrolledWindow()
+            scrolled.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
+            scrolled.set_min_content_height(PREVIEW_HEIGHT)
+            set_margins(scrolled, SIDE_MARGIN)
+            scrolled.add(self.preview_view)
+            self.grid.attach(scrolled, 0, 8, NUMBER_OF_COLUMNS, 1)
+
+            for signal in ('row-changed', 'row-deleted', 'row-inserted'):
+                self.levels.connect(signal, self.on_levels_changed)
+            self.connect('destroy', self.on_destroyed)
+            self.on_levels_changed()
 
         # show the guts
-        scrolled.add(self.grid)
-        content_area.add(scrolled)
+        content_area.add(self.grid)
         self.show_all()
 
-        # set the correct height
-        content_rectangle = self.grid.get_allocation()
-        self.resize(content_rectangle.width+SCROLL_BAR_SIZE,
-                    content_rectangle.height+SCROLL_BAR_SIZE
-                    + ADDITIONAL_HEIGHT)
-
 
     # ----------------------------------
-    def get_sortkeys(self,count):
+    def add_choice_column(self, title, column, choices):
         '''
-              Name: get_sortkeys
-             Usage: sortkeys = dialog.get_sortkeys()
-           Purpose: Get the parameters of how the user wants to sort.
-        Parameters: count    -- initial number of keys to display
-           Returns: sortkeys -- a tuple of tuple of the parameters of the sort
+              Name: add_choice_column
+             Usage: renderer = dialog.add_choice_column(title, column, choices)
+           Purpose: Add a column of combos to the list of sortkeys. The
+                    list holds the ids; the texts are shown.
+        Parameters: title   -- heading of the column
+                    column  -- index in self.levels
+                    choices -- {id:text,...}
+           Returns: renderer -- Gtk.CellRendererCombo of the column
         '''
-        sortkeys = ()
+        renderer = Gtk.CellRendererCombo(model=choice_model(choices), text_column=CHOICE_TEXT,
+                                         has_entry=False, editable=True)
+        renderer.connect('changed', self.on_choice_changed, column)
 
-        # rows have checkbutton for enable/disable
-        for idx in range(0,len(self.controls)):
-            enabled = self.controls[idx][ENABLE_COLUMN]
-            if enabled is None:
-                enabled = 1
-            else:
-                enabled = self.controls[idx][ENABLE_COLUMN].get_active()
-            if enabled:
-                sort_on = self.controls[idx][SORT_ON_COLUMN]
-                if sort_on is None:
-                    sort_on = str(ID_ENTIRE_LINE)
-                else:
-                    sort_on = self.controls[idx][SORT_ON_COLUMN].get_active_id()
-                sortkeys += ((
-                    sort_on,
-                    self.controls[idx][SORT_AS_COLUMN].get_active_id(),
-                    self.controls[idx][SORT_ORDER_COLUMN].get_active_id(),
-                    self.controls[idx][LANGUAGE_COLUMN].get_active_id(),
-                ),)
+        def show_text(tree_column, cell, model, tree_iter, data):
+            value = model[tree_iter][column]
+            cell.set_property('text', choices.get(value, value))
 
-        return sortkeys
+        tree_column = Gtk.TreeViewColumn(title, renderer)
+        tree_column.set_cell_data_func(renderer, show_text)
+        self.tree.append_column(tree_column)
 
+        return renderer
 
-# --------------------------------------
-def query_sortkeys(count):
-    '''
-          Name: query_sortkeys
-         Usage: status, sortkeys = query_sortkeys(count)
-       Purpose: Run a GTK Dialog to get the sortkeys.
-    Parameters: count    -- number of fields
-       Returns: status   -- 0 == OK button, proceed with sort
-                            1 == cancel sort
-                sortkeys -- tuple of sortkeys
-    '''
-    status = SUCCESS
-    sortkeys = ()
 
-    msgbx  = None
-    dialog = SortkeyDialog(None)
-    dialog.show_guts(count)
+    # ----------------------------------
+    def on_languages_opened(self, renderer, editable, path):
+        '''
+              Name: on_languages_opened
+             Usage: (signal handler)
+           Purpose: Add the other languages the first time a Language
+                    combo is opened.
+        Parameters: renderer -- Gtk.CellRendererCombo
+                    editable -- the combo
+                    path     -- of the row
+           Returns: (none)
+        '''
+        if CatalogLoaded:
+            return
+
+        load_catalog()
+        model = renderer.get_property('model')
+        shown = set(row[CHOICE_ID] for row in model)
+        for item in Language_list.items():
+            if item[0] not in shown:
+                model.append(item)
+
+
+    # ----------------------------------
+    def on_toggled(self, renderer, path):
+        '''
+              Name: on_toggled
+             Usage: (signal handler)
+           Purpose: En-/disable a sortkey.
+        Parameters: renderer -- Gtk.CellRendererToggle
+                    path     -- of the row
+           Returns: (none)
+        '''
+        self.levels[path][ENABLE_COLUMN] = not self.levels[path][ENABLE_COLUMN]
+
+
+    # ----------------------------------
+    def on_choice_changed(self, renderer, path, choice_iter, column):
+        '''
+              Name: on_choice_changed
+             Usage: (signal handler)
+           Purpose: Save the id of the choice made in a combo.
+        Parameters: renderer    -- Gtk.CellRendererCombo
+                    path        -- of the row
+                    choice_iter -- of the choice in the combo's model
+                    column      -- index in self.levels
+           Returns: (none)
+        '''
+        model = renderer.get_property('model')
+        self.levels[path][column] = model[choice_iter][CHOICE_ID]
+
+
+    # ----------------------------------
+    def on_levels_changed(self, *args):
+        '''
+              Name: on_levels_changed
+             Usage: (signal handler)
+           Purpose: Update the preview when GTK is next idle, once for
+                    all the changes made until then; dragging a row
+                    makes several.
+        Parameters: args -- of the signal
+           Returns: (none)
+        '''
+        if self.preview_source is None:
+            self.preview_source = GLib.idle_add(self.update_preview)
+
+
+    # ----------------------------------
+    def update_preview(self):
+        '''
+              Name: update_preview
+             Usage: (idle handler)
+           Purpose: Show the first lines sorted as the sortkeys are now.
+        Parameters: (none)
+           Returns: False, so it is not called again
+        '''
+        self.preview_source = None
+        lines = self.preview.first_lines(self.get_sortkeys(), PREVIEW_LINES)
+        self.preview_view.get_buffer().set_text('\n'.join(lines))
+        return False
+
+
+    # ----------------------------------
+    def on_destroyed(self, widget):
+        '''
+              Name: on_destroyed
+             Usage: (signal handler)
+           Purpose: Do not update the preview once the dialog is gone.
+        Parameters: widget -- the dialog
+           Returns: (none)
+        '''
+        if self.preview_source is not None:
+            GLib.source_remove(self.preview_source)
+            self.preview_source = None
+
+
+    # ----------------------------------
+    def on_add_level(self, button):
+        '''
+              Name: on_add_level
+             Usage: (signal handler)
+           Purpose: Add a sortkey for the first field not already used,
+                    in front of the entire line.
+        Parameters: button -- Gtk.Button
+           Returns: (none)
+        '''
+        used = set()
+        line_iter = None
+        for row in self.levels:
+            used.add(row[SORT_ON_COLUMN])
+            if line_iter is None and row[SORT_ON_COLUMN] == str(ID_ENTIRE_LINE):
+                line_iter = row.iter
+
+        sort_on = str(ID_ENTIRE_LINE)
+        for idx in range(0, self.count):
+            if str(idx+1) not in used:
+                sort_on = str(idx+1)
+                break
+
+        level = (True, sort_on, ID_TEXT, ID_ASCENDING, default_language())
+        if line_iter is None or sort_on == str(ID_ENTIRE_LINE):
+            self.levels.append(level)
+        else:
+            self.levels.insert_before(line_iter, level)
+
+
+    # ----------------------------------
+    def on_remove_level(self, button):
+        '''
+              Name: on_remove_level
+             Usage: (signal handler)
+           Purpose: Remove the selected sortkey.
+        Parameters: button -- Gtk.Button
+           Returns: (none)
+        '''
+        model, tree_iter = self.tree.get_selection().get_selected()
+        if tree_iter is not None:
+            model.remove(tree_iter)
+
+
+    # ----------------------------------
+    def get_sortkeys(self):
+        '''
+              Name: get_sortkeys
+             Usage: sortkeys = dialog.get_sortkeys()
+           Purpose: Get the parameters of how the user wants to sort.
+        Parameters: (none)
+           Returns: sortkeys -- a tuple of tuple of the parameters of the sort
+        '''
+        sortkeys = ()
+
+        for row in self.levels:
+            if row[ENABLE_COLUMN]:
+                sortkeys += ((
+                    row[SORT_ON_COLUMN],
+                    row[SORT_AS_COLUMN],
+                    row[SORT_ORDER_COLUMN],
+                    row[LANGUAGE_COLUMN],
+                ),)
+
+        return sortkeys
+
+
+    # ----------------------------------
+    def get_options(self, options):
+        '''
+              Name: get_options
+             Usage: dialog.get_options(options)
+           Purpose: Copy the settings of the options into options.
+        Parameters: options -- from read_options(); is changed
+           Returns: (none)
+        '''
+        options.top    = self.option_controls[0].get_value_as_int()
+        options.rest   = self.option_controls[1].get_active_id()
+        options.unique = self.option_controls[2].get_active()
+        options.count  = self.option_controls[3].get_active()
+
+
+# --------------------------------------
+def query_sortkeys(count, options, total, preview=None):
+    '''
+          Name: query_sortkeys
+         Usage: status, sortkeys = query_sortkeys(count, options, total, preview)
+       Purpose: Run a GTK Dialog to get the sortkeys.
+    Parameters: count    -- number of fields
+                options  -- from read_options(); is changed by the dialog
+                total    -- number of lines
+                preview  -- optional, Preview of the lines
+       Returns: status   -- 0 == OK button, proceed with sort
+                            1 == cancel sort
+                sortkeys -- tuple of sortkeys
+    '''
+    status = SUCCESS
+    sortkeys = ()
+
+    msgbx  = None
+    dialog = SortkeyDialog(None)
+    dialog.show_guts(count, options, total, preview)
 
     while(True):
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            sortkeys = dialog.get_sortkeys(count)
+            sortkeys = dialog.get_sortkeys()
+            dialog.get_options(options)
             if sortkeys:
                 break
 
@@ -558,7 +1688,10 @@ def query_sortkeys(count):
             status = EXIT_STATUS_SORT_CANCELLED
             break
 
-    dialog.hide()
+    # destroy, not hide; a daemon shows many dialogs
+    dialog.destroy()
+    if msgbx:
+        msgbx.destroy()
 
     return status, sortkeys
 
@@ -607,95 +1740,592 @@ def cmp_simple_descend(a, b):
 
 
 # --------------------------------------
-def cmp_collate_ascend(a,b):
+def parse_number(value):
     '''
-          Name: cmp_collate_ascend
-         Usage: cmp = cmp_collate_ascend(a,b)
-       Purpose: Compare 2 strings using the locale ascending.
-    Parameters: a -- any string
-                b -- any string
-       Returns: cmp -- 1 if a>b, 0 if a==b, -1 if a<b
+          Name: parse_number
+         Usage: sort_value = parse_number(value)
+       Purpose: Convert a field to a number, if it is one.
+    Parameters: value      -- the field
+       Returns: sort_value -- float, or value as is
     '''
-    cmp = locale.strcoll(a,b)
-    return cmp
+    try:
+        return float(value)
+    except ValueError:
+        return value
 
 
 # --------------------------------------
-def cmp_collate_descend(a,b):
+def converter(sort_as, sort_lang):
     '''
-          Name: cmp_collate_descend
-         Usage: cmp = cmp_collate_descend(a,b)
-       Purpose: Compare 2 strings using the locale descending.
-    Parameters: a -- any string
-                b -- any string
-       Returns: cmp -- 1 if a<b, 0 if a==b, -1 if a>b
+          Name: converter
+         Usage: convert = converter(sort_as, sort_lang)
+       Purpose: Choose how fields are converted into what is compared.
+                Text sorted by a language is converted to its
+                collation key, which compares as the language orders
+                the text. Safe to use from many threads at once.
+    Parameters: sort_as   -- ID_TEXT or ID_NUMBER
+                sort_lang -- ID_NONE or a language
+       Returns: convert   -- function of a list of fields returning a
+                             list of values, or None if the fields are
+                             compared as they are
+    '''
+    if sort_lang is None:   # a locale without a language, like C
+        sort_lang = ID_NONE
+
+    if sort_as == ID_NUMBER:
+        if sort_lang == ID_NONE:
+            return lambda values: list(map(parse_number, values))
+        return language_for(sort_lang).numbers
+
+    if sort_lang == ID_NONE:
+        return None
+    return language_for(sort_lang).collate
+
+
+# --------------------------------------
+def column_values(fields, column, sort_as, sort_lang, values=None, end=None, progress=None, cache=None):
+    '''
+          Name: column_values
+         Usage: values = column_values(fields, column, sort_as, sort_lang, values, end, progress, cache)
+       Purpose: Convert one field of every line into what is compared.
+                Each different field is converted only once.
+    Parameters: fields    -- Fields
+                column    -- field number or ID_ENTIRE_LINE
+                sort_as   -- ID_TEXT or ID_NUMBER
+                sort_lang -- ID_NONE or a language
+                values    -- optional, the values of the first lines,
+                             already done; is extended
+                end       -- optional, stop before this line
+                progress  -- optional, Progress; checked every chunk
+                cache     -- optional, {field:value,...} of the fields
+                             converted before; is added to
+       Returns: values    -- list of values, one per line
+    '''
+    if values is None:
+        values = []
+    if end is None or end > len(fields):
+        end = len(fields)
+    if cache is None:
+        cache = {}
+
+    convert = converter(sort_as, sort_lang)
+    for start in range(len(values), end, KEY_BUILDER_CHUNK):
+        strings = fields.column(column, start, min(start+KEY_BUILDER_CHUNK, end))
+        if convert is None:
+            values.extend(strings)
+        else:
+            todo = [string for string in dict.fromkeys(strings) if string not in cache]
+            if todo:
+                cache.update(zip(todo, convert(todo)))
+            values.extend(map(cache.__getitem__, strings))
+        if progress is not None:
+            progress.check(len(values) / end)
+
+    return values
+
+
+# --------------------------------------
+def rank_values(values, descending):
+    '''
+          Name: rank_values
+         Usage: ranks = rank_values(values, descending)
+       Purpose: Number the different values in the order they sort.
+                Equal values get the same number. Numbers sort before
+                text, as cmp_simple_ascend() has them.
+    Parameters: values     -- the different values of a column
+                descending -- True to number them largest first
+       Returns: ranks      -- {value:rank,...}
+    '''
+    numbers = sorted(value for value in values if type(value) is float)
+    texts   = sorted(value for value in values if type(value) is not float)
+    ordered = numbers + texts
+    if descending:
+        ordered.reverse()
+
+    ranks = {}
+    for value in ordered:
+        if value not in ranks:  # e.g. 1.0 from both '1' and '1.0'
+            ranks[value] = len(ranks)
+    return ranks
+
+
+# --------------------------------------
+def column_ranks(fields, column, sort_as, sort_lang, descending, values=None, progress=None):
+    '''
+          Name: column_ranks
+         Usage: ranks = column_ranks(fields, column, sort_as, sort_lang, descending, values, progress)
+       Purpose: Replace one field of every line by its rank among the
+                different values of that field. Each different field
+                is converted only once, so a field with only a few
+                values, like a status or a category, costs little
+                however many lines there are. The lines are then
+                sorted on small integers.
+    Parameters: fields     -- Fields
+                column     -- field number or ID_ENTIRE_LINE
+                sort_as    -- ID_TEXT or ID_NUMBER
+                sort_lang  -- ID_NONE or a language
+                descending -- True if the largest sorts first
+                values     -- optional, the values of the first lines,
+                              already done; from KeyBuilder
+                progress   -- optional, Progress; checked every chunk
+       Returns: ranks      -- list of integers, one per line
+    '''
+    if values:
+        # a copy; KeyBuilder or another sortkey may still be using it;
+        # the rest of the lines are converted once per different field
+        values = column_values(fields, column, sort_as, sort_lang, list(values), None, progress)
+        ranks  = rank_values(dict.fromkeys(values), descending)
+        return list(map(ranks.__getitem__, values))
+
+    strings = []
+    for start in range(0, len(fields), KEY_BUILDER_CHUNK):
+        strings.extend(fields.column(column, start, start+KEY_BUILDER_CHUNK))
+        if progress is not None:
+            progress.check(len(strings) / len(fields) / 2)
+
+    different = dict.fromkeys(strings)
+    convert   = converter(sort_as, sort_lang)
+    if convert is not None:
+        todo = list(different)
+        done = []
+        for start in range(0, len(todo), KEY_BUILDER_CHUNK):
+            done.extend(convert(todo[start:start+KEY_BUILDER_CHUNK]))
+            if progress is not None:
+                progress.check((1 + len(done) / len(todo)) / 2)
+        different = dict(zip(todo, done))
+    else:
+        for string in different:
+            different[string] = string
+
+    ranks = rank_values(different.values(), descending)
+    for string, value in different.items():
+        different[string] = ranks[value]
+    return list(map(different.__getitem__, strings))
+
+
+# --------------------------------------
+class KeyBuilder(threading.Thread):
+    '''
+          Name: KeyBuilder
+         Usage: builder = KeyBuilder(fields, count, language)
+                builder.start()
+                columns = builder.finish()
+       Purpose: Convert the fields while the dialog is open, so that
+                little is left to do when OK is pressed. Every field
+                and the entire line are done as text and as number in
+                the default language, the dialog's initial setting.
+    Parameters: fields   -- Fields
+                count    -- number of fields
+                language -- the default language
+       Returns: builder  -- the thread
+    '''
+    def __init__(self, fields, count, language):
+        super().__init__(daemon=True)
+        self.fields   = fields
+        self.stopping = threading.Event()
+
+        # columns[(column,sort_as,language)] is a list that grows as its lines are done
+        self.columns = {}
+        self.caches  = {}   # the values of the different fields of each column
+        if language is None:
+            language = ID_NONE
+        for column in list(range(1, count+1)) + [ID_ENTIRE_LINE]:
+            for sort_as in (ID_TEXT, ID_NUMBER):
+                if language == ID_NONE and sort_as == ID_TEXT:
+                    continue   # nothing to convert
+                self.columns[(column, sort_as, language)] = []
+                self.caches[(column, sort_as, language)]  = {}
+
+
+    # ----------------------------------
+    def run(self):
+        '''
+              Name: run
+             Usage: (called by start())
+           Purpose: Convert the columns a chunk at a time until done or
+                    told to stop.
+        Parameters: (none)
+           Returns: (none)
+        '''
+        for (column, sort_as, sort_lang), values in self.columns.items():
+            cache = self.caches[(column, sort_as, sort_lang)]
+            for start in range(0, len(self.fields), KEY_BUILDER_CHUNK):
+                if self.stopping.is_set():
+                    return
+                column_values(self.fields, column, sort_as, sort_lang,
+                              values, start+KEY_BUILDER_CHUNK, None, cache)
+
+
+    # ----------------------------------
+    def finish(self):
+        '''
+              Name: finish
+             Usage: columns = builder.finish()
+           Purpose: Stop converting and hand over what has been done.
+        Parameters: (none)
+           Returns: columns -- {(column,sort_as,language):[value,...],...}
+                               some lists may be incomplete
+        '''
+        self.stopping.set()
+        self.join()
+        self.caches = {}
+        return self.columns
+
+
+# --------------------------------------
+class Preview:
+    '''
+          Name: Preview
+         Usage: preview = Preview(fields, builder)
+                lines = preview.first_lines(sortkeys, count)
+       Purpose: The first lines as they would be sorted, for the
+                dialog. The keys of each column are kept, so when a
+                sortkey is changed only its column is done again.
+                Nothing is ranked; the lines shown are picked out by
+                a heap, in O(n log count).
+    Parameters: fields  -- Fields
+                builder -- optional, the KeyBuilder, whose converted
+                           columns are used as far as it has got
+       Returns: preview -- .keys: {(column,sort_as,language):[key,...],...}
+    '''
+    def __init__(self, fields, builder=None):
+        self.fields  = fields
+        self.builder = builder
+        self.keys    = {}
+
+
+    # ----------------------------------
+    def column(self, column, sort_as, sort_lang):
+        '''
+              Name: column
+             Usage: keys = preview.column(column, sort_as, sort_lang)
+           Purpose: Get what each line of a column compares by, in
+                    ascending order, from before if it was done before.
+        Parameters: column    -- field number or ID_ENTIRE_LINE
+                    sort_as   -- ID_TEXT or ID_NUMBER
+                    sort_lang -- ID_NONE or a language
+           Returns: keys      -- list of keys, one per line
+        '''
+        keys = self.keys.get((column, sort_as, sort_lang))
+        if keys is not None:
+            return keys
+
+        values = []
+        if self.builder is not None:
+            # a copy; KeyBuilder may still be adding to it
+            values = list(self.builder.columns.get((column, sort_as, sort_lang), ()))
+        values = column_values(self.fields, column, sort_as, sort_lang, values)
+
+        keys = comparable_keys(values, sort_as, False)
+        self.keys[(column, sort_as, sort_lang)] = keys
+        return keys
+
+
+    # ----------------------------------
+    def first_lines(self, sortkeys, count):
+        '''
+              Name: first_lines
+             Usage: lines = preview.first_lines(sortkeys, count)
+           Purpose: Sort only as many lines as are shown.
+        Parameters: sortkeys -- ((field#,sort_as,order,language),...)
+                    count    -- number of lines wanted
+           Returns: lines    -- the first lines, sorted, marked
+        '''
+        return [self.fields.marked.line(self.fields.head + idx)
+                for idx in self.first_order(sortkeys, count)]
+
+
+    # ----------------------------------
+    def first_order(self, sortkeys, count):
+        '''
+              Name: first_order
+             Usage: order = preview.first_order(sortkeys, count)
+           Purpose: Find the first lines as they would be sorted. The
+                    heap finds the key of the last line wanted; the
+                    lines before it are in, and only those equal to it
+                    go on to the next sortkey. The keys are compared
+                    as they are, never through Descending.
+        Parameters: sortkeys -- ((field#,sort_as,order,language),...)
+                    count    -- number of lines wanted
+           Returns: order    -- their line numbers, sorted
+        '''
+        columns = []
+        for column, sort_as, sort_lang, cmp_func in SortPlan(sortkeys).steps:
+            columns.append((self.column(column, sort_as, sort_lang), cmp_func is cmp_simple_descend))
+
+        chosen = []
+        tied   = range(0, len(self.fields))
+        for keys, descending in columns:
+            wanted = count - len(chosen)
+            if wanted <= 0 or len(tied) <= wanted:
+                break
+            if descending:
+                last = heapq.nlargest(wanted, map(keys.__getitem__, tied))[-1]
+                chosen.extend(idx for idx in tied if keys[idx] > last)
+            else:
+                last = heapq.nsmallest(wanted, map(keys.__getitem__, tied))[-1]
+                chosen.extend(idx for idx in tied if keys[idx] < last)
+            tied = [idx for idx in tied if keys[idx] == last]
+        chosen.extend(tied[:count-len(chosen)])   # equal lines keep their order
+
+        # the last sortkey first; each sort is stable, even reversed
+        chosen.sort()
+        for keys, descending in reversed(columns):
+            chosen.sort(key=keys.__getitem__, reverse=descending)
+        return chosen
+
+
+# --------------------------------------
+class SortPlan:
+    '''
+          Name: SortPlan
+         Usage: plan = SortPlan(sortkeys)
+       Purpose: Work out once, not for every line, how each sortkey is
+                made: which field, how it is converted and how it is
+                compared. The keys are then made a column at a time,
+                as ranks from column_ranks(), so all of them compare
+                as ascending integers.
+                A plan can be saved as JSON and loaded again, for
+                presets, the command-line and the daemon.
+    Parameters: sortkeys -- ((field#,sort_as,order,language),...)
+       Returns: plan     -- .sortkeys, and .steps with one
+                            (column,sort_as,language,cmp_func) per sortkey
+    '''
+    def __init__(self, sortkeys):
+        self.sortkeys = tuple(tuple(sortkey) for sortkey in sortkeys)
+        self.steps    = []
+        for sort_on, sort_as, sort_order, sort_lang in self.sortkeys:
+            if sort_order == ID_DESCENDING:
+                cmp_func = cmp_simple_descend
+            else:
+                cmp_func = cmp_simple_ascend
+            self.steps.append((int(sort_on), sort_as, sort_lang, cmp_func))
+
+
+    # ----------------------------------
+    def to_json(self):
+        '''
+              Name: to_json
+             Usage: text = plan.to_json()
+           Purpose: Save the plan.
+        Parameters: (none)
+           Returns: text -- JSON
+        '''
+        return json.dumps({PLAN_SORTKEYS: self.sortkeys})
+
+
+    # ----------------------------------
+    @classmethod
+    def from_json(cls, text):
+        '''
+              Name: from_json
+             Usage: plan = SortPlan.from_json(text)
+           Purpose: Load a plan saved by to_json(). Its sortkeys are
+                    checked as --key checks them, since the file may
+                    have been changed, or saved on another system.
+        Parameters: text -- JSON
+           Returns: plan -- SortPlan
+        '''
+        sortkeys = json.loads(text)[PLAN_SORTKEYS]
+        if not sortkeys:
+            raise argparse.ArgumentTypeError(STRING_EMPTY_PLAN)
+        return cls(tuple(check_sortkey(sortkey, json.dumps(sortkey)) for sortkey in sortkeys))
+
+
+    # ----------------------------------
+    def assign_keys(self, fields, columns=None, progress=None):
+        '''
+              Name: assign_keys
+             Usage: keyed = plan.assign_keys(fields, columns, progress)
+           Purpose: Assign a sortkey to each field in fields.
+        Parameters: fields   -- Fields
+                    columns  -- optional, from KeyBuilder.finish()
+                    progress -- optional, Progress; a step per sortkey
+           Returns: keyed    -- ((line#,(rank,cmp_func),...),...)
+        '''
+        if columns is None:
+            columns = {}
+
+        # done a column at a time, reusing what KeyBuilder has done
+        def ranks_of(step):
+            column, sort_as, sort_lang, cmp_func = step
+            return column_ranks(fields, column, sort_as, sort_lang,
+                                cmp_func is cmp_simple_descend,
+                                columns.get((column, sort_as, sort_lang)), progress)
+
+        # the columns can be done at the same time, in threads, but
+        # that only pays if Python runs them at the same time
+        if len(self.steps) > 1 and len(fields) >= PARALLEL_MINIMUM and not gil_enabled():
+            pool = concurrent.futures.ThreadPoolExecutor()
+            rank_columns = pool.map(ranks_of, self.steps)
+        else:
+            pool = None
+            rank_columns = map(ranks_of, self.steps)
+
+        key_columns = [range(fields.head, fields.head+len(fields))]
+        try:
+            for ranks in rank_columns:
+                key_columns.append(zip(ranks, itertools.repeat(cmp_simple_ascend)))
+                if progress is not None:
+                    progress.step()
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        keyed = tuple(zip(*key_columns))
+        return keyed
+
+
+    # ----------------------------------
+    def line_keys(self, fields, start=0, end=None):
+        '''
+              Name: line_keys
+             Usage: keys = plan.line_keys(fields, start, end)
+           Purpose: Make a key for each line that compares as the
+                    sortkeys do with <, without ranking the whole
+                    column, so only the lines wanted are converted.
+        Parameters: fields -- Fields
+                    start  -- optional, first line
+                    end    -- optional, stop before this line
+           Returns: keys   -- [(value,...),...], one per line
+        '''
+        key_columns = []
+        for column, sort_as, sort_lang, cmp_func in self.steps:
+            strings = fields.column(column, start, end)
+
+            # the key of each different field is made once, and the
+            # lines with that field share it
+            different = list(dict.fromkeys(strings))
+            values    = different
+            convert   = converter(sort_as, sort_lang)
+            if convert is not None:
+                values = convert(different)
+            values = comparable_keys(values, sort_as, cmp_func is cmp_simple_descend)
+            keys = dict(zip(different, values))
+            key_columns.append(map(keys.__getitem__, strings))
+        return list(zip(*key_columns))
+
+
+# --------------------------------------
+class Descending:
+    '''
+          Name: Descending
+         Usage: key = Descending(value)
+       Purpose: A value that compares the other way, for the
+                descending sortkeys of comparable_keys().
+    Parameters: value -- anything that compares with <
+       Returns: key   -- .value
     '''
-    return locale.strcoll(b,a)
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
 
 
 # --------------------------------------
-def assign_keys(fields, sortkeys):
+def comparable_keys(values, sort_as, descending):
+    '''
+          Name: comparable_keys
+         Usage: keys = comparable_keys(values, sort_as, descending)
+       Purpose: Make converted values of a column compare with < as
+                the sortkey does: numbers before text, as rank_values()
+                has them, and the other way round if descending.
+    Parameters: values     -- converted values, from converter()
+                sort_as    -- ID_TEXT or ID_NUMBER
+                descending -- True if the largest sorts first
+       Returns: keys       -- list, one per value
+    '''
+    if sort_as == ID_NUMBER and not all(type(value) is float for value in values):
+        values = [(type(value) is not float, value) for value in values]
+    if descending:
+        values = list(map(Descending, values))
+    return values
+
+
+# --------------------------------------
+def assign_keys(fields, sortkeys, columns=None):
     '''
           Name: assign_keys
-         Usage: keyed = assign_keys(fields, sortkeys)
+         Usage: keyed = assign_keys(fields, sortkeys, columns)
        Purpose: Assign a sortkey to each field in fields
-    Parameters: fields   -- ((marked,line,field1,field2,...),...)
+    Parameters: fields   -- Fields
                 sortkeys -- ((field#,sort_as,type,order),...)
-       Returns: keyed    -- ((marked,(field,sort_as,type,wants_descending)),...)
+                columns  -- optional, from KeyBuilder.finish()
+       Returns: keyed    -- ((line#,(value,cmp_func),...),...)
     '''
+    return SortPlan(sortkeys).assign_keys(fields, columns)
 
-    keyed = ()
-    for field in fields:
 
-        keys_list = (field[0],)
-        for sortkey in sortkeys:
+# --------------------------------------
+def equality_key(keys):
+    '''
+          Name: equality_key
+         Usage: key = equality_key(keys)
+       Purpose: Create a hashable key that is equal for two items
+                exactly when cmp_fields() says they are equal. Text
+                sorted by a language is already its collation key so
+                the same strength of comparison applies.
+    Parameters: keys -- ((value,cmp_func),...), the sortkeys of an item
+       Returns: key  -- tuple of values
+    '''
+    key = ()
+    for value, cmp_func in keys:
+        key += (value,)
+    return key
 
-            # check for missing fields
-            sort_value = EMPTY_STRING
-            if int(sortkey[0]) < len(field)-1:
-                sort_value = field[int(sortkey[0])]
-
-            sort_as    = sortkey[1]
-            sort_order = sortkey[2]
-            sort_lang  = sortkey[3]
-
-            if sort_lang == ID_NONE:
-                if sort_as == ID_TEXT:
-                    if sort_order == ID_DESCENDING:
-                        key = (sort_value,cmp_simple_descend,)
-                    else:
-                        key = (sort_value,cmp_simple_ascend,)
-                elif sort_as == ID_NUMBER:
-                    try:
-                        sort_value = float(sort_value)
-                    except:
-                        # ignore all exceptions; use sort_value as is
-                        pass
-                    if sort_order == ID_DESCENDING:
-                        key = (sort_value,cmp_simple_descend,)
-                    else:
-                        key = (sort_value,cmp_simple_ascend,)
-            else:
-                if sort_as == ID_TEXT:
-                    if sort_order == ID_DESCENDING:
-                        key = (sort_value,cmp_collate_descend,)
-                    else:
-                        key = (sort_value,cmp_collate_ascend,)
-                elif sort_as == ID_NUMBER:
-                    try:
-                        sort_value = float(locale.delocalize(sort_value))
-                    except:
-                        # ignore all exceptions; use sort_value as is
-                        pass
-                    if sort_order == ID_DESCENDING:
-                        key = (sort_value,cmp_simple_descend,)
-                    else:
-                        key = (sort_value,cmp_simple_ascend,)
 
-            keys_list += (key,)
-        keyed += (keys_list,)
+# --------------------------------------
+def remove_duplicates(keyed):
+    '''
+          Name: remove_duplicates
+         Usage: keyed, counts = remove_duplicates(keyed)
+       Purpose: Keep only the first item of those with equal sortkeys.
+                This is done with a hash table before sorting so the
+                duplicates are never sorted.
+    Parameters: keyed  -- ((line#,(value,cmp_func),...),...)
+       Returns: keyed  -- ((line#,(value,cmp_func),...),...)
+                counts -- the number of each item in keyed
+    '''
+    first  = {}
+    counts = []
+    unique = []
+    for item in keyed:
+        key = equality_key(item[1:])
+        idx = first.get(key)
+        if idx is None:
+            first[key] = len(unique)
+            unique.append(item)
+            counts.append(1)
+        else:
+            counts[idx] += 1
 
-    return keyed
+    return unique, counts
+
+
+# --------------------------------------
+def counted_lines(marked, keyed, counts):
+    '''
+          Name: counted_lines
+         Usage: replaced = counted_lines(marked, keyed, counts)
+       Purpose: Put the number of duplicates in front of each line,
+                after any bullet.
+    Parameters: marked   -- Lines of Zim marked text
+                keyed    -- from remove_duplicates()
+                counts   -- from remove_duplicates()
+       Returns: replaced -- {line#:line,...} for Lines.join()
+    '''
+    replaced = {}
+    for idx in range(0, len(keyed)):
+        line   = marked.line(keyed[idx][0])
+        bullet = BULLET_PATTERN.match(line).end()
+        replaced[keyed[idx][0]] = line[:bullet] + str(counts[idx]) + ' ' + line[bullet:]
+    return replaced
 
 
 # --------------------------------------
@@ -704,8 +2334,8 @@ def cmp_fields(a, b):
           Name: cmp_fields
          Usage: cmp = cmp_fields(a, b)
        Purpose: Complex compare of 2 fields
-    Parameters: a -- (marked_line,[value,type,language,wants_descending],...)
-                b -- (marked_line,[value,type,language,wants_descending],...)
+    Parameters: a -- (line#,(value,cmp_func),...)
+                b -- (line#,(value,cmp_func),...)
        Returns: cmp -- 1 if a>b, 0 if a==b, -1 if a<b
     '''
     for idx in range(1,len(a)):
@@ -718,35 +2348,744 @@ def cmp_fields(a, b):
 
 
 # --------------------------------------
-def sort_fields(keyed):
+def find_disorder(keyed):
+    '''
+          Name: find_disorder
+         Usage: idx = find_disorder(keyed)
+       Purpose: Find the first item that sorts before the one in front
+                of it. Stops as soon as one is found.
+    Parameters: keyed -- ((line#,(value,cmp_func),...),...)
+       Returns: idx   -- index of the out-of-order item, None if sorted
+    '''
+    for idx in range(1, len(keyed)):
+        if cmp_fields(keyed[idx-1], keyed[idx]) > 0:
+            return idx
+
+    return None
+
+
+# --------------------------------------
+def find_runs(keyed):
+    '''
+          Name: find_runs
+         Usage: runs = find_runs(keyed)
+       Purpose: Find where each already sorted run of items starts.
+                Compares each pair of neighbours once.
+    Parameters: keyed -- ((line#,(value,cmp_func),...),...)
+       Returns: runs  -- start indexes of the runs; one run means the
+                         items are already sorted
+    '''
+    runs = [0]
+    for idx in range(1, len(keyed)):
+        if cmp_fields(keyed[idx-1], keyed[idx]) > 0:
+            runs.append(idx)
+
+    return runs
+
+
+# --------------------------------------
+def pack_integer_keys(keyed):
+    '''
+          Name: pack_integer_keys
+         Usage: packed = pack_integer_keys(keyed)
+       Purpose: If every sortkey is a rank or a whole number, pack
+                the sortkeys of each item into one integer that sorts
+                the same way. Each sortkey gets a fixed number of bits,
+                just enough for its range: the value less the smallest
+                value when ascending, the largest value less the value
+                when descending, so that negatives and descending need
+                no special compare.
+    Parameters: keyed  -- ((line#,(value,cmp_func),...),...)
+       Returns: packed -- [integer,...], one per item; None if any
+                          sortkey is text or not a whole number
+    '''
+    if not keyed:
+        return None
+
+    packed = [0] * len(keyed)
+    for idx in range(1, len(keyed[0])):
+        values = [item[idx][0] for item in keyed]
+        if not all(type(value) is int for value in values):   # not ranks
+            try:
+                if not all(map(float.is_integer, values)):
+                    return None
+            except TypeError:   # text
+                return None
+            values = list(map(int, values))
+
+        low    = min(values)
+        high   = max(values)
+        width  = (high - low).bit_length()
+        if keyed[0][idx][1] is cmp_simple_descend:
+            packed = [(key << width) | (high - value) for key, value in zip(packed, values)]
+        else:
+            packed = [(key << width) | (value - low) for key, value in zip(packed, values)]
+
+    return packed
+
+
+# --------------------------------------
+def sort_fields(keyed, runs=None):
     '''
           Name: sort_fields
-         Usage: ordered = sort_fields(keyed)
+         Usage: ordered = sort_fields(keyed, runs)
        Purpose: Do the sort.
-    Parameters: keyed   -- ((marked,(field,sort_as,type,wants_descending)),...)
+    Parameters: keyed   -- ((line#,(value,cmp_func),...),...)
+                runs    -- optional, from find_runs()
        Returns: ordered -- sorted marked lines
     '''
 
     # Do not reverse the sort. Reverse is done individually by field.
     # That is, some fields may be ascending and others descending.
     # Reversing has to been deep in the sort per field.
+    if runs is not None and len(runs) <= MERGE_RUNS_LIMIT:
+        # heapq.merge() is stable, so merging the runs gives the same
+        # order as sorting them
+        bounds = runs + [len(keyed)]
+        pieces = [keyed[bounds[idx]:bounds[idx+1]] for idx in range(0, len(runs))]
+        ordered = list(heapq.merge(*pieces, key=functools.cmp_to_key(cmp_fields)))
+        return ordered
+
+    # ranks and whole numbers are sorted by one integer each, without cmp_fields()
+    packed = pack_integer_keys(keyed)
+    if packed is not None:
+        order   = sorted(range(0, len(keyed)), key=packed.__getitem__)
+        ordered = [keyed[idx] for idx in order]
+        return ordered
+
     ordered = sorted(keyed, key=functools.cmp_to_key(cmp_fields))
     return ordered
 
 
 # --------------------------------------
-def extract_marked(ordered):
+def select_top(keys, lines, top):
+    '''
+          Name: select_top
+         Usage: ordered, rest = select_top(keys, lines, top)
+       Purpose: Sort only the first few lines. A heap keeps the best
+                `top` lines seen so far, so the cost is O(n log top)
+                rather than O(n log n). The keys are not ranked, since
+                that sorts every different value of a column.
+    Parameters: keys    -- from SortPlan.line_keys()
+                lines   -- the line numbers to choose from, in order
+                top     -- number of lines wanted
+       Returns: ordered -- line numbers of the first `top`, sorted
+                rest    -- the other line numbers, in their order
+    '''
+    # heapq.nsmallest() is stable, like sorted()
+    ordered = heapq.nsmallest(top, lines, key=keys.__getitem__)
+
+    chosen = set(ordered)
+    rest = [line for line in lines if line not in chosen]
+
+    return ordered, rest
+
+
+# --------------------------------------
+def sorted_prefix(keys):
+    '''
+          Name: sorted_prefix
+         Usage: size = sorted_prefix(keys)
+       Purpose: Find how many lines at the top are already sorted.
+    Parameters: keys -- from SortPlan.line_keys()
+       Returns: size -- number of lines
+    '''
+    for idx in range(1, len(keys)):
+        if keys[idx] < keys[idx-1]:
+            return idx
+    return len(keys)
+
+
+# --------------------------------------
+def insert_order(plan, fields):
     '''
-          Name: extract_marked
-         Usage: lines = extract_marked(ordered)
-       Purpose: Extract the marked text from a complex structure.
-    Parameters: ordered -- ((line,stuff...),...)
-       Returns: lines -- the lines from the structure
+          Name: insert_order
+         Usage: order = insert_order(plan, fields)
+       Purpose: Sort lines that are sorted but for some added at the
+                end. Only the added lines are sorted; each is then put
+                in its place in the sorted lines by a binary search.
+                Equal lines stay in their order, as sort_fields()
+                leaves them.
+    Parameters: plan   -- SortPlan
+                fields -- Fields
+       Returns: order  -- line numbers, sorted; None if they already are
     '''
-    lines = ()
+    keys = plan.line_keys(fields)
+    size = sorted_prefix(keys)
+    if size == len(keys):
+        return None
+
+    order = []
+    pos   = 0
+    for idx in sorted(range(size, len(keys)), key=keys.__getitem__):
+        place = bisect.bisect_right(keys, keys[idx], pos, size)
+        order.extend(range(pos, place))
+        order.append(idx)
+        pos = place
+    order.extend(range(pos, size))
+
+    return [fields.head+idx for idx in order]
+
+
+# --------------------------------------
+def extract_order(ordered):
+    '''
+          Name: extract_order
+         Usage: order = extract_order(ordered)
+       Purpose: Extract the line numbers from a complex structure.
+    Parameters: ordered -- ((line#,stuff...),...)
+       Returns: order   -- the line numbers from the structure
+    '''
+    order = []
     for item in ordered:
-        lines += (item[0],)
-    return lines
+        order.append(item[0])
+    return order
+
+
+# --------------------------------------
+class SortCancelled(Exception):
+    '''
+          Name: SortCancelled
+         Usage: raise SortCancelled()
+       Purpose: Stops a sort when Cancel is pressed.
+    '''
+    pass
+
+
+# --------------------------------------
+class Progress:
+    '''
+          Name: Progress
+         Usage: progress = Progress()
+       Purpose: How far a sort has got, shared between the sort, in a
+                worker thread, and the window that shows it. The sort
+                calls step() after each part and check() after each
+                chunk of lines in a part; that is where it stops if
+                Cancel was pressed.
+    Parameters: (none)
+       Returns: progress -- .steps, the number of parts, .done and
+                            .part, how much of the next part is done
+    '''
+    def __init__(self):
+        self.steps     = 1
+        self.done      = 0
+        self.part      = 0.0
+        self.cancelled = threading.Event()
+
+
+    # ----------------------------------
+    def step(self):
+        '''
+              Name: step
+             Usage: progress.step()
+           Purpose: Count a part as done.
+        Parameters: (none)
+           Returns: (none); raises SortCancelled if cancelled
+        '''
+        if self.cancelled.is_set():
+            raise SortCancelled()
+        self.done += 1
+        self.part  = 0.0
+
+
+    # ----------------------------------
+    def check(self, part):
+        '''
+              Name: check
+             Usage: progress.check(part)
+           Purpose: Note how much of a part is done.
+        Parameters: part -- from 0.0 to 1.0
+           Returns: (none); raises SortCancelled if cancelled
+        '''
+        if self.cancelled.is_set():
+            raise SortCancelled()
+        self.part = part
+
+
+    # ----------------------------------
+    def fraction(self):
+        '''
+              Name: fraction
+             Usage: fraction = progress.fraction()
+           Purpose: How much is done, for a progress bar.
+        Parameters: (none)
+           Returns: fraction -- from 0.0 to 1.0
+        '''
+        return min((self.done + self.part) / self.steps, 1.0)
+
+
+    # ----------------------------------
+    def cancel(self):
+        '''
+              Name: cancel
+             Usage: progress.cancel()
+           Purpose: Stop the sort at its next step.
+        Parameters: (none)
+           Returns: (none)
+        '''
+        self.cancelled.set()
+
+
+# --------------------------------------
+def run_with_progress(work):
+    '''
+          Name: run_with_progress
+         Usage: status, output = run_with_progress(work)
+       Purpose: Do the work in a thread while a window shows how far it
+                has got, with a Cancel button. GTK keeps running, so
+                Zim does not look frozen and Cancel is seen at once.
+                The work stops at its next check; it is not waited
+                for, so the window closes at once.
+    Parameters: work   -- function(progress) returning (status,output)
+       Returns: status -- from work, or EXIT_STATUS_SORT_CANCELLED
+                output -- from work, or None if cancelled
+    '''
+    progress = Progress()
+    results  = []
+
+    dialog = Gtk.Dialog(title=STRING_TITLE, flags=0)
+    dialog.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+    bar = Gtk.ProgressBar(show_text=True)
+    bar.set_text(STRING_SORTING)
+    set_margins(bar, 10)
+    dialog.get_content_area().add(bar)
+    dialog.show_all()
+
+    def run():
+        try:
+            results.append(work(progress))
+        except SortCancelled:
+            pass
+        except Exception as error:
+            results.append(error)
+
+    def update():
+        bar.set_fraction(progress.fraction())
+        if worker.is_alive():
+            return True
+        dialog.response(Gtk.ResponseType.OK)
+        return False
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    timer = GLib.timeout_add(PROGRESS_INTERVAL, update)
+
+    response = dialog.run()
+    if response != Gtk.ResponseType.OK:   # Cancel, or the window was closed
+        # the worker stops by itself; it is a daemon thread, so it
+        # does not keep this program running
+        progress.cancel()
+        GLib.source_remove(timer)
+        dialog.destroy()
+        return EXIT_STATUS_SORT_CANCELLED, None
+
+    worker.join()
+    dialog.destroy()
+    if isinstance(results[0], Exception):
+        raise results[0]
+    return results[0]
+
+
+# --------------------------------------
+class MemoryReport:
+    '''
+          Name: MemoryReport
+         Usage: report = MemoryReport(enabled)
+                with report.stage(name): ...
+                report.write()
+       Purpose: Measure the memory used by each stage of a sort with
+                tracemalloc: the most it used at once (peak) and what
+                it left behind for the next stages (retained). Does
+                nothing if not enabled, so the stages cost nothing
+                when not measured.
+    Parameters: enabled -- True to measure
+       Returns: report  -- .stages: [(name,peak,retained),...] and
+                           .lines, the number of lines in the input
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages  = []
+        self.lines   = 0
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+    # ----------------------------------
+    def add(self, name, peak, retained):
+        '''
+              Name: add
+             Usage: report.add(name, peak, retained)
+           Purpose: Add a stage measured some other way.
+        Parameters: name     -- of the stage
+                    peak     -- bytes
+                    retained -- bytes
+           Returns: (none)
+        '''
+        if self.enabled:
+            self.stages.append((name, peak, retained))
+
+
+    # ----------------------------------
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+              Name: stage
+             Usage: with report.stage(name): ...
+           Purpose: Measure a stage.
+        Parameters: name -- of the stage
+           Returns: (none)
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        before = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, 'reset_peak'):   # Python 3.9
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            self.stages.append((name, peak-before, current-before))
+
+
+    # ----------------------------------
+    def write(self, file=None):
+        '''
+              Name: write
+             Usage: report.write(file)
+           Purpose: Stop measuring and write a table of the stages.
+        Parameters: file  -- optional, default is sys.stderr
+           Returns: (none)
+        '''
+        if not self.enabled:
+            return
+        if file is None:
+            file = sys.stderr
+        tracemalloc.stop()
+
+        print(sys.argv[0], ': ', STRING_MEMORY, sep=EMPTY_STRING, file=file)
+        print('{:<10} {:>14} {:>14} {:>10}'.format(EMPTY_STRING, STRING_PEAK, STRING_RETAINED,
+                                                   STRING_PER_LINE), file=file)
+        for name, peak, retained in self.stages:
+            print('{:<10} {:>14,} {:>14,} {:>10,}'.format(name, peak, retained,
+                                                          peak // max(self.lines, 1)), file=file)
+
+
+# --------------------------------------
+def sort_selection(options, report=None):
+    '''
+          Name: sort_selection
+         Usage: status, output = sort_selection(options, report)
+       Purpose: Sort the selections given as arguments. Messages are
+                written to sys.stderr.
+    Parameters: options -- from read_options()
+                report  -- optional, a MemoryReport of the stages
+       Returns: status  -- SUCCESS or one of the EXIT_STATUS_*
+                output  -- the text to replace the selection
+    '''
+    if report is None:
+        report = MemoryReport(False)
+
+    text,  marked = read_text(options)
+    report.add('input', sys.getsizeof(marked) + (sys.getsizeof(text) if text is not None else 0), 0)
+    with report.stage('lines'):
+        marked_lines  = Lines(marked)   # also preserves blank lines
+        text_lines    = None            # made from marked_lines if needed
+        if text is not None:
+            text_lines = Lines(text)
+            if len(text_lines) != len(marked_lines):
+                text_lines = None
+    report.lines = len(marked_lines)
+    with report.stage('fields'):
+        head = find_table(marked_lines)
+        if head is not None:
+            count, fields = get_cells(text_lines, marked_lines, head)
+        elif options.records:
+            # the records are sorted in place of the lines
+            marked_lines, marked_heads = group_records(marked_lines, options.records)
+            text_heads = None
+            if text_lines is not None:
+                text_heads = group_records(text_lines, options.records)[1]
+                if len(text_heads) != len(marked_heads):
+                    text_heads = None
+            count, fields = get_fields(text_heads, marked_heads, options.markup)
+        else:
+            count, fields = get_fields(text_lines, marked_lines, options.markup)
+
+    columns = None
+    if options.plan:
+        status, sortkeys = SUCCESS, options.plan.sortkeys
+    elif options.key:
+        status, sortkeys = SUCCESS, tuple(options.key)
+    else:
+        # build the keys while the user is busy with the dialog
+        builder = KeyBuilder(fields, count, default_language())
+        builder.start()
+        status, sortkeys = query_sortkeys(count, options, len(fields), Preview(fields, builder))
+        columns = builder.finish()
+    if status != SUCCESS:   # user cancelled sort
+        return status, marked   # marked has its own newline at end
+
+    plan = SortPlan(sortkeys)
+    if options.save_plan:
+        try:
+            with open(options.save_plan, 'w') as saved:
+                saved.write(plan.to_json())
+        except OSError as error:
+            # the sort is still done; only the plan is lost
+            print(sys.argv[0], ': ', STRING_NOT_SAVED, error, sep=EMPTY_STRING, file=sys.stderr)
+
+    def work(progress):
+        return arrange_lines(options, plan, fields, columns, marked, marked_lines, report, progress)
+
+    if columns is not None and len(fields) >= PROGRESS_MINIMUM:
+        # after the dialog, so Zim is waiting; show it is not stuck
+        status, output = run_with_progress(work)
+        if status == EXIT_STATUS_SORT_CANCELLED:
+            return status, marked
+        return status, output
+
+    return work(Progress())
+
+
+# --------------------------------------
+def arrange_lines(options, plan, fields, columns, marked, marked_lines, report, progress):
+    '''
+          Name: arrange_lines
+         Usage: status, output = arrange_lines(options, plan, fields, columns, marked,
+                                               marked_lines, report, progress)
+       Purpose: Sort the lines once the sortkeys are known.
+    Parameters: options      -- from read_options()
+                plan         -- SortPlan
+                fields       -- Fields
+                columns      -- None, or from KeyBuilder.finish()
+                marked       -- the Zim marked text
+                marked_lines -- Lines of it, or records
+                report       -- MemoryReport of the stages
+                progress     -- Progress; a step per sortkey and per stage
+       Returns: status       -- SUCCESS or one of the EXIT_STATUS_*
+                output       -- the text to replace the selection
+    '''
+    if options.insert and not (options.check or options.top or options.unique or options.count):
+        progress.steps = 2
+        with report.stage('insert'):
+            order = insert_order(plan, fields)
+        progress.step()
+        if order is None:
+            # already sorted; leave the selection exactly as it is
+            return SUCCESS, marked
+
+        with report.stage('join'):
+            output = marked_lines.join(list(range(0, fields.head)) + order, None, progress)
+        progress.step()
+        return SUCCESS, output
+
+    if 0 < options.top < len(fields) and not (options.check or options.unique or options.count):
+        # only the top lines are sorted, so no column is ranked
+        progress.steps = 3
+        with report.stage('keys'):
+            keys = plan.line_keys(fields)
+        progress.step()
+        with report.stage('sort'):
+            order, rest = select_top(keys, range(0, len(fields)), options.top)
+            if options.rest == ID_APPEND:
+                order += rest
+        progress.step()
+
+        with report.stage('join'):
+            output = marked_lines.join(list(range(0, fields.head)) + order, None, progress)
+        progress.step()
+        return SUCCESS, output
+
+    progress.steps = len(plan.steps) + 2
+    with report.stage('keys'):
+        keyed = plan.assign_keys(fields, columns, progress)
+
+    changed  = False
+    replaced = None
+    if (options.unique or options.count) and not options.check:
+        with report.stage('unique'):
+            size = len(keyed)
+            keyed, counts = remove_duplicates(keyed)
+            changed = options.count or len(keyed) != size
+            if options.count:
+                replaced = counted_lines(marked_lines, keyed, counts)
+
+    if options.check:
+        # the selection is never changed by a check
+        with report.stage('check'):
+            idx = find_disorder(keyed)
+        if idx is not None:
+            line = keyed[idx][0]
+            print(sys.argv[0], ': ', STRING_DISORDER, marked_lines.line_number(line), ': ',
+                  fields.marked.line(line), sep=EMPTY_STRING, file=sys.stderr)
+            return EXIT_STATUS_NOT_SORTED, marked
+        return SUCCESS, marked
+
+    with report.stage('sort'):
+        if 0 < options.top < len(keyed):
+            # the lines left by --unique or --count
+            order, rest = select_top(plan.line_keys(fields), extract_order(keyed), options.top)
+            if options.rest == ID_APPEND:
+                order += rest
+        else:
+            runs = find_runs(keyed)
+            if len(runs) == 1 and not changed:
+                # already sorted; leave the selection exactly as it is
+                return SUCCESS, marked
+            order = extract_order(sort_fields(keyed, runs))
+    progress.step()
+
+    with report.stage('join'):
+        output = marked_lines.join(list(range(0, fields.head)) + order, replaced, progress)
+    progress.step()
+    return SUCCESS, output
+
+
+# --------------------------------------
+def socket_path():
+    '''
+          Name: socket_path
+         Usage: path = socket_path()
+       Purpose: Where the daemon listens. The same is done in
+                field_sort_client.py, which cannot import this file
+                without paying for the GTK import.
+    Parameters: (none)
+       Returns: path -- of the UNIX socket
+    '''
+    path = os.environ.get(SOCKET_ENVIRONMENT)
+    if not path:
+        folder = os.environ.get('XDG_RUNTIME_DIR')
+        if not folder:
+            # /tmp is shared; use a folder only the user can get into
+            folder = os.path.join('/tmp', SOCKET_FOLDER.format(os.getuid()))
+        path = os.path.join(folder, SOCKET_NAME.format(os.getuid()))
+    return path
+
+
+# --------------------------------------
+def is_private(path):
+    '''
+          Name: is_private
+         Usage: if is_private(path): ...
+       Purpose: Check that no one else can have put the socket there
+                or can replace it: its folder is the user's and only
+                the user can write in it, or is sticky like /tmp; the
+                socket, if there is one, is the user's.
+    Parameters: path -- of the UNIX socket
+       Returns: True if it is safe to use
+    '''
+    uid = os.getuid()
+    try:
+        folder = os.lstat(os.path.dirname(path) or '.')
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISDIR(folder.st_mode):   # not a symbolic link either
+        return False
+    if folder.st_uid not in (uid, 0):
+        return False
+    if folder.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and not folder.st_mode & stat.S_ISVTX:
+        return False
+
+    try:
+        sock = os.lstat(path)
+    except FileNotFoundError:
+        return True
+    return stat.S_ISSOCK(sock.st_mode) and sock.st_uid == uid
+
+
+# --------------------------------------
+def serve_request(args, cwd=None):
+    '''
+          Name: serve_request
+         Usage: reply = serve_request(args, cwd)
+       Purpose: Do one sort for the daemon, exactly as if this program
+                had been run with the arguments in the client's
+                folder, so that --plan and --save-plan find their
+                files where the client would. Only one is done at a
+                time, so the daemon's folder can be changed for it.
+    Parameters: args  -- the command-line arguments, without the program
+                cwd   -- optional, the client's folder
+       Returns: reply -- {'status':..., 'output':..., 'errors':...};
+                         output has what was printed, like --help,
+                         before the sorted text
+    '''
+    errors  = io.StringIO()
+    printed = io.StringIO()
+    output  = EMPTY_STRING
+    saved   = os.getcwd()
+    with contextlib.redirect_stderr(errors), contextlib.redirect_stdout(printed):
+        try:
+            if cwd is not None:
+                os.chdir(cwd)
+            options = read_options(args)
+            report  = MemoryReport(options.memory)
+            status, output = sort_selection(options, report)
+            report.write()
+        except SystemExit as exiting:   # from argparse
+            status = exiting.code or SUCCESS
+            if status != SUCCESS:
+                output = guess_selection(args)   # Zim replaces the selection with it
+        except Exception as error:
+            print(sys.argv[0], ': ', repr(error), sep=EMPTY_STRING, file=sys.stderr)
+            status = EXIT_STATUS_INTERNAL_ERROR
+            output = guess_selection(args)
+        finally:
+            os.chdir(saved)
+
+    return {'status': status, 'output': printed.getvalue() + output, 'errors': errors.getvalue()}
+
+
+# --------------------------------------
+async def serve(path):
+    '''
+          Name: serve
+         Usage: asyncio.run(serve(path))
+       Purpose: Run the daemon. Each client connection sends one JSON
+                request, {'args': [...], 'cwd': ...}, and closes its
+                side; the reply from serve_request() is sent back as
+                JSON. The languages, compiled patterns and the GTK
+                import are kept from one request to the next.
+    Parameters: path -- of the UNIX socket
+       Returns: (none)
+    '''
+    lock = asyncio.Lock()   # one dialog at a time
+
+    async def handle(reader, writer):
+        try:
+            request = json.loads(await reader.read())
+            async with lock:
+                reply = serve_request(request['args'], request.get('cwd'))
+            writer.write(json.dumps(reply).encode())
+            await writer.drain()
+        finally:
+            writer.close()
+
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+    if not is_private(path):
+        print(sys.argv[0], ': ', STRING_UNSAFE, path, sep=EMPTY_STRING, file=sys.stderr)
+        return
+
+    # remove a socket left by a daemon that is no longer running
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+                print(sys.argv[0], ': ', STRING_RUNNING, path,
+                      sep=EMPTY_STRING, file=sys.stderr)
+                return
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(path)
+
+    # made with only the user allowed to connect; no moment when others may
+    saved = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle, path=path)
+    finally:
+        os.umask(saved)
+    async with server:
+        await server.serve_forever()
 
 
 # --------------------------------------
@@ -760,20 +3099,28 @@ def main():
     '''
     load_languages()
 
-    text,     marked          = read_text()
-    frontage, newline, ending = get_newline(marked)        # also preserves trailing blank lines
-    count,    fields          = get_fields(text, marked)   # fields also contain unmarked & marked lines
+    try:
+        options = read_options()
+    except SystemExit as exiting:   # from argparse
+        if exiting.code:
+            # Zim replaces the selection with the output; keep it
+            print(guess_selection(sys.argv[1:]), end=EMPTY_STRING)
+        raise
+    if options.daemon:
+        asyncio.run(serve(socket_path()))
+        return
 
-    status, sortkeys = query_sortkeys(count)
-    if status != SUCCESS:   # user cancelled sort
-        print(marked, end=EMPTY_STRING)   # marked has its own newline at end
-        exit(status)
-
-    keyed   = assign_keys(fields, sortkeys)
-    ordered = sort_fields(keyed)
-    lines   = extract_marked(ordered)
-    marked  = newline.join(lines)
-    print(frontage, marked, sep=EMPTY_STRING, end=ending)
+    try:
+        report = MemoryReport(options.memory)
+        status, output = sort_selection(options, report)
+        report.write()
+    except Exception as error:
+        # Zim replaces the selection with the output; keep it
+        print(sys.argv[0], ': ', repr(error), sep=EMPTY_STRING, file=sys.stderr)
+        status = EXIT_STATUS_INTERNAL_ERROR
+        output = guess_selection(sys.argv[1:])
+    print(output, end=EMPTY_STRING)
+    exit(status)
 
 
 # don't execute if imported
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+'''
+     Title: Field Sort Client
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+     Usage: **/field_sort_client.py -- %T
+            The command for this tool is: `**/field_sort_client.py -- %T`
+            where `**` represents the path to the tool.
+            It takes the same arguments as `field_sort.py`.
+
+            If `field_sort.py --daemon` is running, the sort is
+            done by it, which saves starting Python, importing GTK
+            and loading the languages for every sort. Otherwise,
+            `field_sort.py` is run in this process.
+
+   Purpose: Sort Zim Desktop Wiki lines by fields.
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+
+            See LICENCE.md for details.
+'''
+
+
+# --------------------------------------
+# Imports
+# Keep these few; importing is most of the time saved.
+import sys
+import os
+import stat
+import json
+import socket
+
+
+# --------------------------------------
+# constants
+EMPTY_STRING = ''
+
+# must agree with field_sort.py
+SOCKET_ENVIRONMENT = 'FIELD_SORT_SOCKET'
+SOCKET_NAME        = 'field_sort-{}.sock'
+SOCKET_FOLDER      = 'field_sort-{}'   # the user's own, in /tmp
+
+BUFFER_SIZE = 65536
+
+
+# --------------------------------------
+# Subroutines
+
+# --------------------------------------
+def socket_path():
+    '''
+          Name: socket_path
+         Usage: path = socket_path()
+       Purpose: Where the daemon listens. Same as in field_sort.py.
+    Parameters: (none)
+       Returns: path -- of the UNIX socket
+    '''
+    path = os.environ.get(SOCKET_ENVIRONMENT)
+    if not path:
+        folder = os.environ.get('XDG_RUNTIME_DIR')
+        if not folder:
+            # /tmp is shared; use a folder only the user can get into
+            folder = os.path.join('/tmp', SOCKET_FOLDER.format(os.getuid()))
+        path = os.path.join(folder, SOCKET_NAME.format(os.getuid()))
+    return path
+
+
+# --------------------------------------
+def is_private(path):
+    '''
+          Name: is_private
+         Usage: if is_private(path): ...
+       Purpose: Same as in field_sort.py. Check that no one else
+                can have put the socket there or can replace it.
+    Parameters: path -- of the UNIX socket
+       Returns: True if it is safe to use
+    '''
+    uid = os.getuid()
+    try:
+        folder = os.lstat(os.path.dirname(path) or '.')
+    except FileNotFoundError:
+        return False
+    if not stat.S_ISDIR(folder.st_mode):   # not a symbolic link either
+        return False
+    if folder.st_uid not in (uid, 0):
+        return False
+    if folder.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and not folder.st_mode & stat.S_ISVTX:
+        return False
+
+    try:
+        sock = os.lstat(path)
+    except FileNotFoundError:
+        return True
+    return stat.S_ISSOCK(sock.st_mode) and sock.st_uid == uid
+
+
+# --------------------------------------
+def ask_daemon(args):
+    '''
+          Name: ask_daemon
+         Usage: reply = ask_daemon(args)
+       Purpose: Send the arguments and the folder they are relative to
+                to the daemon and wait for the sort.
+    Parameters: args  -- the command-line arguments, without the program
+       Returns: reply -- {'status':..., 'output':..., 'errors':...}
+                         or None if there is no daemon, or none that
+                         can be trusted with the page
+    '''
+    path = socket_path()
+    if not is_private(path):
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        client.sendall(json.dumps({'args': args, 'cwd': os.getcwd()}).encode())
+        client.shutdown(socket.SHUT_WR)
+
+        chunks = []
+        while True:
+            chunk = client.recv(BUFFER_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    return json.loads(b''.join(chunks))
+
+
+# --------------------------------------
+def main():
+    '''
+          Name: main
+         Usage: main()
+       Purpose: Isolates execution of the program from importing.
+    Parameters: (none)
+       Returns: (none)
+    '''
+    reply = ask_daemon(sys.argv[1:])
+    if reply is None:
+        # no daemon; sort in this process
+        sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+        import field_sort
+        field_sort.main()
+        return
+
+    print(reply['errors'], end=EMPTY_STRING, file=sys.stderr)
+    print(reply['output'], end=EMPTY_STRING)
+    exit(reply['status'])
+
+
+# don't execute if imported
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+'''
+     Title: Field Sort Notebook
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+     Usage: **/field_sort_notebook.py [--option[=value] ...] --plan=FILE NOTEBOOK
+            where `**` represents the path to the tool.
+
+            Sorts every block of marked lines on every page of a Zim
+            notebook with the sortkeys saved by
+            `field_sort.py --save-plan=FILE`. A block is a run of
+            lines that all have a field, or that all match --rule.
+            The pages are done in parallel and written back only if
+            they change, by replacing the whole file at once.
+
+   Purpose: Sort Zim Desktop Wiki lines by fields.
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+
+            See LICENCE.md for details.
+'''
+
+
+# --------------------------------------
+# Imports
+import sys
+import os
+import re
+import time
+import shutil
+import difflib
+import argparse
+import tempfile
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import field_sort
+
+
+# --------------------------------------
+# constants
+EMPTY_STRING = ''
+PAGE_SUFFIX  = '.txt'   # Zim pages
+
+# lines, split on '\n' only, as field_sort.Lines does, with their ends
+LINE_PATTERN = re.compile('[^\n]*\n|[^\n]+')
+
+# Zim verbatim blocks and objects, like code, are never sorted;
+# each is the pattern that starts it and the one that ends it
+REGION_PATTERNS = ((re.compile(r"^[ \t]*'''[ \t]*$"), re.compile(r"^[ \t]*'''[ \t]*$")),
+                   (re.compile(r'^[ \t]*\{\{\{'),      re.compile(r'\}\}\}[ \t]*$')))
+
+# inline verbatim, whose text is not looked at for fields
+INLINE_VERBATIM = re.compile("''.*?''")
+
+# exit status if a page could not be sorted
+EXIT_STATUS_PAGE_FAILED = 1
+
+# Internationalization
+_ = field_sort._
+
+STRING_DESCRIPTION  = _('Sort the marked lines on every page of a Zim notebook.')
+STRING_HELP_PLAN    = _('the sortkeys to use, saved by field_sort.py --save-plan=FILE')
+STRING_HELP_MARKUP  = _('what marks the fields, as for field_sort.py')
+STRING_HELP_RULE    = _('sort blocks of lines that match REGEX, not blocks of lines with fields')
+STRING_HELP_DRY_RUN = _('show what would change, as a diff, and change nothing')
+STRING_HELP_JOBS    = _('number of pages done at once; default is the number of CPUs')
+STRING_BAD_RULE     = _('invalid rule: ')
+STRING_PAGE_FAILED  = _('not sorted: ')
+STRING_STATS        = _('{pages} pages, {blocks} blocks, {lines} lines, {changed} changed '
+                        'in {seconds:.2f} s: {page_rate:.0f} pages/s, {line_rate:.0f} lines/s')
+
+
+# --------------------------------------
+# Subroutines
+
+# --------------------------------------
+def parse_rule(spec):
+    '''
+          Name: parse_rule
+         Usage: pattern = parse_rule(spec)
+       Purpose: Compile the --rule.
+    Parameters: spec    -- a regular expression
+       Returns: pattern -- compiled
+    '''
+    try:
+        return re.compile(spec)
+    except re.error as error:
+        raise argparse.ArgumentTypeError(STRING_BAD_RULE + str(error))
+
+
+# --------------------------------------
+def read_options(args=None):
+    '''
+          Name: read_options
+         Usage: options = read_options(args)
+       Purpose: Get the options from the command-line.
+    Parameters: args    -- optional, default is the command-line
+       Returns: options -- the options
+    '''
+    parser = argparse.ArgumentParser(description=STRING_DESCRIPTION)
+    parser.add_argument('--plan', type=field_sort.load_plan, required=True,
+                        metavar='FILE', help=STRING_HELP_PLAN)
+    parser.add_argument('--markup', type=field_sort.parse_markup, default=(field_sort.ID_MARK,),
+                        metavar='KIND', help=STRING_HELP_MARKUP)
+    parser.add_argument('--rule', type=parse_rule, metavar='REGEX', help=STRING_HELP_RULE)
+    parser.add_argument('--dry-run', action='store_true', help=STRING_HELP_DRY_RUN)
+    parser.add_argument('--jobs', type=int, metavar='N', help=STRING_HELP_JOBS)
+    parser.add_argument('notebook')
+    return parser.parse_args(args)
+
+
+# --------------------------------------
+def find_pages(notebook):
+    '''
+          Name: find_pages
+         Usage: paths = find_pages(notebook)
+       Purpose: Find the pages of a notebook.
+    Parameters: notebook -- its folder
+       Returns: paths    -- of the pages, in order
+    '''
+    paths = []
+    for folder, subfolders, files in os.walk(notebook):
+        subfolders[:] = sorted(name for name in subfolders if not name.startswith('.'))
+        for name in sorted(files):
+            if name.endswith(PAGE_SUFFIX):
+                paths.append(os.path.join(folder, name))
+    return paths
+
+
+# --------------------------------------
+def find_blocks(page, rule, kinds):
+    '''
+          Name: find_blocks
+         Usage: blocks = find_blocks(page, rule, kinds)
+       Purpose: Split a page into the blocks to sort and what is
+                between them. The lines of verbatim blocks and of
+                objects, like code, are never sorted; nor are fields
+                inside inline verbatim looked at.
+    Parameters: page   -- the text of the page
+                rule   -- compiled pattern, or None for lines that
+                          have a field
+                kinds  -- tuple of the kinds of markup
+       Returns: blocks -- [(sort,text),...] where sort is True for a
+                          block to sort; together they are the page
+    '''
+    inline = None
+    if rule is None:
+        rule = field_sort.field_pattern(kinds)
+        if field_sort.ID_VERBATIM not in kinds:
+            inline = INLINE_VERBATIM
+
+    blocks = []
+    closer = None   # the end of the verbatim block or object the line is in
+    for line in LINE_PATTERN.findall(page):
+        text = line.rstrip('\r\n')
+        if closer is not None:
+            sort = False
+            if closer.search(text):
+                closer = None
+        else:
+            sort = True
+            for opener, ender in REGION_PATTERNS:
+                found = opener.search(text)
+                if found:
+                    sort = False
+                    # an object may end on the line it starts on
+                    if not ender.search(text, found.end()):
+                        closer = ender
+                    break
+            if sort:
+                if inline is not None:
+                    text = inline.sub(EMPTY_STRING, text)
+                sort = rule.search(text) is not None
+        if blocks and blocks[-1][0] == sort:
+            blocks[-1][1].append(line)
+        else:
+            blocks.append((sort, [line]))
+
+    return [(sort, EMPTY_STRING.join(lines)) for sort, lines in blocks]
+
+
+# --------------------------------------
+def sort_block(block, plan, kinds):
+    '''
+          Name: sort_block
+         Usage: status, output = sort_block(block, plan, kinds)
+       Purpose: Sort a block as the Custom Tool would.
+    Parameters: block  -- Zim marked text
+                plan   -- field_sort.SortPlan
+                kinds  -- tuple of the kinds of markup
+       Returns: status -- SUCCESS or one of the EXIT_STATUS_*
+                output -- the sorted block
+    '''
+    options = field_sort.read_options(['--', block])
+    options.plan   = plan
+    options.markup = kinds
+    return field_sort.sort_selection(options)
+
+
+# --------------------------------------
+def write_page(path, page):
+    '''
+          Name: write_page
+         Usage: write_page(path, page)
+       Purpose: Replace a page all at once, so Zim never sees half of
+                it, even if this is stopped part way.
+    Parameters: path -- of the page
+                page -- its new text
+       Returns: (none)
+    '''
+    folder, name = os.path.split(path)
+    with tempfile.NamedTemporaryFile('w', dir=folder, prefix='.' + name, suffix='.new',
+                                     delete=False, encoding='utf-8', newline=EMPTY_STRING) as new:
+        try:
+            new.write(page)
+            new.flush()
+            os.fsync(new.fileno())
+            shutil.copymode(path, new.name)
+        except BaseException:
+            os.unlink(new.name)
+            raise
+    os.replace(new.name, path)
+
+
+# --------------------------------------
+def sort_page(path, plan, kinds, rule, dry_run):
+    '''
+          Name: sort_page
+         Usage: path, blocks, lines, diff = sort_page(path, plan, kinds, rule, dry_run)
+       Purpose: Sort every block of a page and write it back if it
+                changed. Run in the worker processes.
+    Parameters: path    -- of the page
+                plan    -- field_sort.SortPlan
+                kinds   -- tuple of the kinds of markup
+                rule    -- compiled pattern, or None
+                dry_run -- True to only make the diff
+       Returns: path    -- of the page
+                blocks  -- number of blocks sorted
+                lines   -- number of lines in them
+                diff    -- the change as a unified diff; empty if none
+    '''
+    with open(path, encoding='utf-8', newline=EMPTY_STRING) as old:
+        page = old.read()
+
+    pieces = []
+    blocks = 0
+    lines  = 0
+    for sort, block in find_blocks(page, rule, kinds):
+        if sort:
+            status, output = sort_block(block, plan, kinds)
+            if status == field_sort.SUCCESS:
+                block = output
+            blocks += 1
+            lines  += len(LINE_PATTERN.findall(block))
+        pieces.append(block)
+    sorted_page = EMPTY_STRING.join(pieces)
+
+    if sorted_page == page:
+        return path, blocks, lines, EMPTY_STRING
+
+    diff = EMPTY_STRING.join(difflib.unified_diff(LINE_PATTERN.findall(page),
+                                                  LINE_PATTERN.findall(sorted_page),
+                                                  path, path))
+    if not dry_run:
+        write_page(path, sorted_page)
+    return path, blocks, lines, diff
+
+
+# --------------------------------------
+def main():
+    '''
+          Name: main
+         Usage: main()
+       Purpose: Isolates execution of the program from importing.
+    Parameters: (none)
+       Returns: (none)
+    '''
+    field_sort.load_languages()
+    options = read_options()
+
+    start   = time.perf_counter()
+    paths   = find_pages(options.notebook)
+    blocks  = 0
+    lines   = 0
+    changed = 0
+    failed  = 0
+    with concurrent.futures.ProcessPoolExecutor(options.jobs, initializer=field_sort.load_languages) as pool:
+        jobs = [(path, pool.submit(sort_page, path, options.plan, options.markup, options.rule, options.dry_run))
+                for path in paths]
+        for path, job in jobs:
+            try:
+                path, page_blocks, page_lines, diff = job.result()
+            except Exception as error:
+                # the page is left as it was; go on with the others
+                print(sys.argv[0], ': ', STRING_PAGE_FAILED, path, ': ', error,
+                      sep=EMPTY_STRING, file=sys.stderr)
+                failed += 1
+                continue
+            blocks += page_blocks
+            lines  += page_lines
+            if diff:
+                changed += 1
+                if options.dry_run:
+                    print(diff, end=EMPTY_STRING)
+    seconds = time.perf_counter() - start
+
+    print(STRING_STATS.format(pages=len(paths), blocks=blocks, lines=lines, changed=changed,
+                              seconds=seconds, page_rate=len(paths) / max(seconds, 1e-9),
+                              line_rate=lines / max(seconds, 1e-9)), file=sys.stderr)
+    if failed:
+        exit(EXIT_STATUS_PAGE_FAILED)
+
+
+# don't execute if imported
+if __name__ == '__main__':
+    main()
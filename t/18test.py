@@ -0,0 +1,52 @@
+#!/bin/env python3
+'''
+     Title: 18test
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+   Purpose: Test the Field Sort for the Zinm Desktop Wiki.
+
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import subprocess
+import os
+import re
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+field_sort = cwd + "/../field_sort.py"
+
+marked = """
+* Kai, __Cashier__
+* Olivia, __Cook__
+* Amelia, __Cashier__
+* Liam, __Janitor__
+* Noah, __Cook__
+* Emma, __Cashier__
+"""
+
+print('unique, then count')
+print(marked)
+
+lines = re.sub('__', '', marked)
+output = subprocess.run([field_sort, '--unique', '--key=1', '--', marked, lines],
+                        capture_output=True, text=True).stdout
+print(output)
+
+output = subprocess.run([field_sort, '--count', '--key=1', '--', marked, lines],
+                        capture_output=True, text=True).stdout
+print(output)
@@ -0,0 +1,52 @@
+#!/bin/env python3
+'''
+     Title: 19test
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+   Purpose: Test the Field Sort for the Zinm Desktop Wiki.
+
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import subprocess
+import os
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+field_sort = cwd + "/../field_sort.py"
+
+marked = """| Name | Job | Pay |
+|------|:---:|----:|
+| Kai | Cashier | 12.50 |
+| Olivia | Cook\\|Baker | 15 |
+|Amelia|Cashier|9.75|
+| Liam | Janitor | 11 |
+| Noah | Cook | 14.25 |
+| Emma | | 10 |"""
+
+print('table, by job then pay')
+print(marked)
+
+output = subprocess.run([field_sort, '--key=2', '--key=3:number:descending', '--', marked],
+                        capture_output=True, text=True).stdout
+print(output)
+
+print('table, by name, without the header')
+rows = '\n'.join(marked.split('\n')[2:])
+output = subprocess.run([field_sort, '--key=1', '--', rows],
+                        capture_output=True, text=True).stdout
+print(output)
@@ -0,0 +1,749 @@
+#!/bin/env python3
+'''
+     Title: differential
+ Copyright: Copyright 2023 by Shawn H Corey. Some rights reserved.
+     Usage: t/differential.py [--cases=N] [--seed=N]
+   Purpose: Check that every way Field Sort has of sorting gives the
+            same result as the plain one: lines and fields found with
+            the regular expressions Field Sort first used, and keys
+            made a line at a time and sorted with its first compares.
+            The pages are made at random and from the pages of the
+            other tests. A failure is cut down to the fewest lines
+            and sortkeys that still fail before it is shown.
+
+   Licence: This file is part of Field Sort.
+
+            Field Sort is free software: you can
+            redistribute it and/or modify it under the terms of
+            the GNU General Public License as published by the
+            Free Software Foundation, either version 3 of the
+            License, or (at your option) any later version.
+
+            Field Sort is distributed in the hope that
+            it will be useful, but WITHOUT ANY WARRANTY; without
+            even the implied warranty of MERCHANTABILITY or
+            FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+            General Public License for more details.
+
+            You should have received a copy of the GNU General
+            Public License along with Field Sort.
+            If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import contextlib
+import functools
+import glob
+import locale
+import os
+import random
+import re
+import sys
+
+cwd = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, cwd + "/..")
+import field_sort
+
+# not 'nan': it compares equal to everything, so there is no one right order
+WORDS = ('apple', 'Banana', 'banana', 'cherry', 'Éclair', 'zebra', 'x1',
+         '10', '9.5', '-3', '1e3', '0', '1,000.5', 'inf', '-inf', ' ', '')
+WHOLE = ('10', '-3', '0', '1e3', '007', '-12345678901234567890', '42')
+GAPS  = ('\n', '\n\n', '\r\n', '\n \n')
+STARTS = ('r ', 'r ', 'r ', '* ', '1. ', '[ ] ', '\u2022 ')   # bullets, for --count
+
+# Zim tables; a cell may have an escaped `|`
+CELLS = ('apple', 'banana', 'Éclair', '10', '-3', '9.5', '', ' ', 'a\\|b', '__x__', '__1__ y')
+TABLE_LINE = re.compile(r'^[ \t]*\|.*\|[ \t]*$')
+RULE_LINE  = re.compile(r'^[ \t]*\|(?:[ \t]*:?-+:?[ \t]*\|)+[ \t]*$')
+
+# what is in front of a line that --count puts the count after
+BULLET = re.compile(r'^(\s*(?:(?:[*\u2022]|\[[ *x<>]\]|\d+\.|[a-zA-Z]\.)\s+|\|))?')
+SEED_PATTERN = re.compile(r'^marked = """(.*?)"""', re.M | re.S)
+
+
+# --------------------------------------
+def seed_pages():
+    '''
+          Name: seed_pages
+         Usage: pages = seed_pages()
+       Purpose: The pages of the numbered tests.
+    Parameters: (none)
+       Returns: pages -- [marked,...]
+    '''
+    pages = []
+    for path in sorted(glob.glob(cwd + '/[0-9]*test.py')):
+        with open(path) as test:
+            pages += SEED_PATTERN.findall(test.read())
+    return pages
+
+
+# --------------------------------------
+def random_page(rng, seeds):
+    '''
+          Name: random_page
+         Usage: marked, extra = random_page(rng, seeds)
+       Purpose: Make a page to sort: a test page with its lines
+                shuffled, or lines of random fields, some missing,
+                some numbers, some not, with blank lines between.
+    Parameters: rng    -- random.Random
+                seeds  -- from seed_pages()
+       Returns: marked -- the Zim marked text
+                extra  -- more options to sort it with
+    '''
+    extra = rng.choice(((), (), ('--unique',), ('--count',)))
+
+    if rng.random() < 0.15:
+        return random_table(rng), extra
+
+    if rng.random() < 0.15:
+        kind = rng.choice((field_sort.ID_BULLETS, field_sort.ID_PARAGRAPHS))
+        return random_records(rng, kind), extra + ('--records=' + kind,)
+
+    if seeds and rng.random() < 0.25:
+        lines = rng.choice(seeds).split('\n')
+        rng.shuffle(lines)
+        return '\n'.join(lines), extra
+
+    # only whole numbers, for pack_integer_keys()
+    words = rng.choice((WORDS, WORDS, WHOLE))
+
+    rows = []
+    for idx in range(0, rng.randint(1, 30)):
+        fields = []
+        for column in range(0, 3 if words is WHOLE else rng.randint(0, 4)):
+            word = rng.choice(words)
+            if words is WHOLE or rng.random() < 0.7:
+                word = '__' + word + '__'
+            fields.append(word)
+        rows.append(rng.choice(STARTS) + ' '.join(fields))
+
+    # mostly sorted pages have few runs; they are merged, not sorted
+    if rng.random() < 0.3:
+        rows.sort()
+        if len(rows) > 1:
+            idx = rng.randrange(0, len(rows)-1)
+            rows[idx], rows[idx+1] = rows[idx+1], rows[idx]
+
+    gap = rng.choice(GAPS)
+    return rng.choice(('', '\n')) + gap.join(rows) + rng.choice(('', '\n', '\n\n')), extra
+
+
+# --------------------------------------
+def random_table(rng):
+    '''
+          Name: random_table
+         Usage: marked = random_table(rng)
+       Purpose: Make a Zim table to sort, sometimes with a header,
+                with cells padded or not, some missing.
+    Parameters: rng    -- random.Random
+       Returns: marked -- the Zim marked text
+    '''
+    rows = []
+    if rng.random() < 0.5:
+        rows.append('| Name | Value |')
+        rows.append(rng.choice(('|---|---|', '|:--|--:|', '| --- |')))
+    for idx in range(0, rng.randint(1, 20)):
+        cells = []
+        for column in range(0, rng.randint(1, 3)):
+            pad = rng.choice(('', ' ', '  ', '\t'))
+            cells.append(pad + rng.choice(CELLS) + rng.choice(('', ' ')))
+        rows.append(rng.choice(('', ' ')) + '|' + '|'.join(cells) + '|')
+    return '\n'.join(rows) + rng.choice(('', '\n'))
+
+
+# --------------------------------------
+def random_records(rng, kind):
+    '''
+          Name: random_records
+         Usage: marked = random_records(rng, kind)
+       Purpose: Make a page of records to sort: bullets with lines
+                indented under them, or paragraphs between blank
+                lines, the fields in their first lines.
+    Parameters: rng    -- random.Random
+                kind   -- ID_BULLETS or ID_PARAGRAPHS
+       Returns: marked -- the Zim marked text
+    '''
+    base = rng.choice(('', '  '))
+    pieces = []
+    for idx in range(0, rng.randint(1, 12)):
+        if pieces:
+            if kind == field_sort.ID_PARAGRAPHS:
+                pieces.append(rng.choice(('\n\n', '\r\n\r\n', '\n\n\n')))
+            else:
+                pieces.append(rng.choice(('\n', '\r\n', '\n\n')))
+        fields = ' '.join('__' + rng.choice(WORDS) + '__' for column in range(0, rng.randint(0, 2)))
+        pieces.append(base + rng.choice(STARTS) + fields)
+        for line in range(0, rng.randint(0, 3)):
+            pieces.append(rng.choice(('\n', '\r\n')))
+            if kind == field_sort.ID_PARAGRAPHS:
+                pieces.append(rng.choice(('', '  ')) + rng.choice(WORDS))
+            else:
+                pieces.append(base + rng.choice(('  ', '\t', '    ')) + rng.choice(STARTS) + rng.choice(WORDS))
+    return ''.join(pieces) + rng.choice(('', '\n'))
+
+
+# --------------------------------------
+def random_sortkeys(rng, languages):
+    '''
+          Name: random_sortkeys
+         Usage: sortkeys = random_sortkeys(rng, languages)
+       Purpose: Make the sortkeys for a sort.
+    Parameters: rng       -- random.Random
+                languages -- to choose from
+       Returns: sortkeys  -- ((field#,sort_as,order,language),...)
+    '''
+    sortkeys = []
+    for idx in range(0, rng.randint(1, 3)):
+        sortkeys.append((rng.choice(('1', '2', '3', str(field_sort.ID_ENTIRE_LINE))),
+                         rng.choice((field_sort.ID_TEXT, field_sort.ID_NUMBER)),
+                         rng.choice((field_sort.ID_ASCENDING, field_sort.ID_DESCENDING)),
+                         rng.choice(languages)))
+    return tuple(sortkeys)
+
+
+# --------------------------------------
+def unmark(marked):
+    '''
+          Name: unmark
+         Usage: text = unmark(marked)
+       Purpose: Remove the marks, as Zim does for %t, the plain way:
+                every doubled mark goes, and links leave their label.
+    Parameters: marked -- the Zim marked text
+       Returns: text   -- the unmarked text
+    '''
+    for mark in ('__', '**', '~~', "''"):
+        marked = marked.replace(mark, '')
+    marked = re.sub(r'(?<!:)//', '', marked)
+    return re.sub(r'\[\[(?:[^|\]]*\|)?(.*?)\]\]', r'\1', marked)
+
+
+# --------------------------------------
+def reference_split(marked):
+    '''
+          Name: reference_split
+         Usage: frontage, lines, gaps, ending = reference_split(marked)
+       Purpose: Split the page into lines as Field Sort first did, with
+                regular expressions, keeping every gap between them.
+    Parameters: marked   -- the Zim marked text
+       Returns: frontage -- newlines in front of the lines
+                lines    -- [line,...]
+                gaps     -- [newlines,...], one fewer than the lines
+                ending   -- newlines after the lines
+    '''
+    frontage = ''
+    found = re.search('^((?:\r?\n)+)', marked)
+    if found:
+        frontage = found.group(1)
+    marked = re.sub('^(?:\r?\n)+', '', marked)
+
+    ending = ''
+    found = re.search('((?:\r?\n)+)$', marked)
+    if found:
+        ending = found.group(1)
+    marked = re.sub('(?:\r?\n)+$', '', marked)
+
+    pieces = re.split('((?:\r?\n)+)', marked)
+    return frontage, pieces[0::2], pieces[1::2], ending
+
+
+# --------------------------------------
+def reference_fields(lines):
+    '''
+          Name: reference_fields
+         Usage: rows = reference_fields(lines)
+       Purpose: Find the fields as Field Sort first did.
+    Parameters: lines -- from reference_split()
+       Returns: rows  -- [(marked,field1,field2,...,unmarked),...]
+    '''
+    rows = []
+    for line in lines:
+        row = (line,)
+        for each in re.findall('__[^_]*(?:(?:_[^_]+))*__', line):
+            row += (re.search(r'__(.*)__', each).group(1),)
+        row += (unmark(line),)
+        rows.append(row)
+    return rows
+
+
+# --------------------------------------
+def reference_table(lines):
+    '''
+          Name: reference_table
+         Usage: head = reference_table(lines)
+       Purpose: Check if the lines are a Zim table and find how many
+                lines at its top, down to the `|---|` row, stay there.
+    Parameters: lines -- from reference_split()
+       Returns: head  -- number of lines; None if it is not a table
+    '''
+    if not all(TABLE_LINE.match(line) for line in lines):
+        return None
+    for idx, line in enumerate(lines):
+        if RULE_LINE.match(line):
+            return idx + 1
+    return 0
+
+
+# --------------------------------------
+def reference_cells(lines):
+    '''
+          Name: reference_cells
+         Usage: rows = reference_cells(lines)
+       Purpose: Use the cells of the table rows as their fields: split
+                on each `|` that is not escaped, without the spaces
+                around them.
+    Parameters: lines -- the rows of the table, not the header
+       Returns: rows  -- [(marked,cell1,cell2,...,unmarked),...]
+    '''
+    rows = []
+    for line in lines:
+        cells = re.split(r'(?<!\\)\|', line)[1:-1]
+        rows.append((line,) + tuple(cell.strip(' \t') for cell in cells) + (unmark(line),))
+    return rows
+
+
+# --------------------------------------
+def reference_records(lines, gaps, kind):
+    '''
+          Name: reference_records
+         Usage: records, heads, between = reference_records(lines, gaps, kind)
+       Purpose: Put the lines that are sorted as one together: a bullet
+                with the lines indented more than the first line, or
+                the lines up to a blank line.
+    Parameters: lines   -- from reference_split()
+                gaps    -- from reference_split()
+                kind    -- ID_BULLETS or ID_PARAGRAPHS
+       Returns: records -- [text,...], with the gaps inside them
+                heads   -- [line,...], the first line of each
+                between -- [newlines,...], the gaps between them
+    '''
+    base = len(re.match('[ \t]*', lines[0]).group(0))
+    records = [lines[0]]
+    heads   = [lines[0]]
+    between = []
+    for idx in range(1, len(lines)):
+        if kind == field_sort.ID_PARAGRAPHS:
+            new = gaps[idx-1].count('\n') > 1
+        else:
+            new = len(re.match('[ \t]*', lines[idx]).group(0)) <= base
+        if new:
+            records.append(lines[idx])
+            heads.append(lines[idx])
+            between.append(gaps[idx-1])
+        else:
+            records[-1] += gaps[idx-1] + lines[idx]
+    return records, heads, between
+
+
+# --------------------------------------
+@contextlib.contextmanager
+def in_language(sort_lang):
+    '''
+          Name: in_language
+         Usage: with in_language(sort_lang): ...
+       Purpose: Set the locale of the process to a language for a
+                while, the plain way.
+    Parameters: sort_lang -- ID_NONE or a language
+       Returns: (none)
+    '''
+    if sort_lang in (field_sort.ID_NONE, field_sort.AppLanguage):
+        yield
+        return
+
+    saved = (locale.setlocale(locale.LC_COLLATE), locale.setlocale(locale.LC_NUMERIC))
+    locale.setlocale(locale.LC_COLLATE, sort_lang)
+    locale.setlocale(locale.LC_NUMERIC, sort_lang)
+    try:
+        yield
+    finally:
+        locale.setlocale(locale.LC_COLLATE, saved[0])
+        locale.setlocale(locale.LC_NUMERIC, saved[1])
+
+
+# --------------------------------------
+# The compares of the first Field Sort
+
+def cmp_ascend(a, b):
+    try:
+        return (a>b)-(a<b)
+    except TypeError:
+        if type(a) is str:
+            return 1
+        elif type(b) is str:
+            return -1
+        else:
+            return 0
+
+def cmp_descend(a, b):
+    try:
+        return (a<b)-(a>b)
+    except TypeError:
+        if type(a) is str:
+            return -1
+        elif type(b) is str:
+            return 1
+        else:
+            return 0
+
+def cmp_collate_ascend(a, b):
+    return locale.strcoll(a, b)
+
+def cmp_collate_descend(a, b):
+    return locale.strcoll(b, a)
+
+
+# --------------------------------------
+def reference_keys(rows, sortkeys):
+    '''
+          Name: reference_keys
+         Usage: keyed = reference_keys(rows, sortkeys)
+       Purpose: Make the keys a line at a time, as Field Sort first
+                did: a missing field is empty, a number that is not
+                one stays text, and text in a language is compared
+                with strcoll(), the language set as it is compared.
+    Parameters: rows     -- from reference_fields()
+                sortkeys -- ((field#,sort_as,order,language),...)
+       Returns: keyed    -- [(line#,(value,cmp_func,language),...),...]
+    '''
+    keyed = []
+    for idx, row in enumerate(rows):
+        keys = (idx,)
+        for sort_on, sort_as, sort_order, sort_lang in sortkeys:
+            value = ''
+            if int(sort_on) < len(row)-1:
+                value = row[int(sort_on)]
+
+            descending = sort_order == field_sort.ID_DESCENDING
+            if sort_as == field_sort.ID_NUMBER:
+                try:
+                    if sort_lang == field_sort.ID_NONE:
+                        value = float(value)
+                    else:
+                        with in_language(sort_lang):
+                            value = float(locale.delocalize(value))
+                except ValueError:
+                    pass
+                cmp_func = cmp_descend if descending else cmp_ascend
+            elif sort_lang == field_sort.ID_NONE:
+                cmp_func = cmp_descend if descending else cmp_ascend
+            else:
+                cmp_func = cmp_collate_descend if descending else cmp_collate_ascend
+            keys += ((value, cmp_func, sort_lang),)
+        keyed.append(keys)
+    return keyed
+
+
+# --------------------------------------
+def reference_cmp(a, b):
+    '''
+          Name: reference_cmp
+         Usage: cmp = reference_cmp(a, b)
+       Purpose: Compare two lines on their keys, in their languages.
+    Parameters: a, b -- from reference_keys()
+       Returns: cmp  -- 1 if a>b, 0 if a==b, -1 if a<b
+    '''
+    for idx in range(1, len(a)):
+        value, cmp_func, sort_lang = a[idx]
+        with in_language(sort_lang):
+            cmp = cmp_func(value, b[idx][0])
+        if cmp != 0:
+            return cmp
+    return 0
+
+
+# --------------------------------------
+def reference_order(marked, sortkeys):
+    '''
+          Name: reference_order
+         Usage: order = reference_order(marked, sortkeys)
+       Purpose: Sort the plain way, with none of Field Sort's own
+                structures. With PyICU, Field Sort collates with ICU,
+                which may not agree with strcoll() for every string.
+    Parameters: marked   -- the Zim marked text
+                sortkeys -- ((field#,sort_as,order,language),...)
+       Returns: order    -- line numbers, sorted
+    '''
+    rows  = reference_fields(reference_split(marked)[1])
+    keyed = sorted(reference_keys(rows, sortkeys), key=functools.cmp_to_key(reference_cmp))
+    return [keys[0] for keys in keyed]
+
+
+# --------------------------------------
+def reference_selection(marked, sortkeys, extra=()):
+    '''
+          Name: reference_selection
+         Usage: output = reference_selection(marked, sortkeys, extra)
+       Purpose: Sort the selection the plain way, as sort_selection()
+                should: the lines in order, each gap staying where it
+                was, a table by its cells under its header, records
+                by their first lines. With --unique or --count, only the first of the
+                lines that compare equal is kept; with --count, the
+                number of them goes in front of it, after any bullet.
+    Parameters: marked   -- the Zim marked text
+                sortkeys -- ((field#,sort_as,order,language),...)
+                extra    -- more options, as given to pipeline()
+       Returns: output   -- the text that replaces the selection
+    '''
+    frontage, lines, gaps, ending = reference_split(marked)
+    texts = list(lines)
+    head  = reference_table(lines)
+    kinds = [option.split('=')[1] for option in extra if option.startswith('--records=')]
+    if head is None and kinds:
+        head = 0
+        texts, heads, gaps = reference_records(lines, gaps, kinds[0])
+        rows = reference_fields(heads)
+    elif head is None:
+        head = 0
+        rows = reference_fields(lines)
+    else:
+        rows = reference_cells(lines[head:])
+    keyed = sorted(reference_keys(rows, sortkeys), key=functools.cmp_to_key(reference_cmp))
+    keyed = [((head+keys[0]),) + keys[1:] for keys in keyed]
+
+    if '--unique' in extra or '--count' in extra:
+        kept   = []
+        counts = {}
+        for keys in keyed:
+            if kept and reference_cmp(kept[-1], keys) == 0:
+                counts[kept[-1][0]] += 1
+            else:
+                kept.append(keys)
+                counts[keys[0]] = 1
+        keyed = kept
+        if '--count' in extra:
+            for idx, count in counts.items():
+                bullet = BULLET.match(texts[idx]).end()
+                texts[idx] = texts[idx][:bullet] + str(count) + ' ' + texts[idx][bullet:]
+
+    pieces = [frontage]
+    for pos, idx in enumerate(list(range(0, head)) + [keys[0] for keys in keyed]):
+        if pos > 0:
+            pieces.append(gaps[pos-1])
+        pieces.append(texts[idx])
+    pieces.append(ending)
+    return ''.join(pieces)
+
+
+# --------------------------------------
+# The engines; each returns the sorted line numbers
+
+def engine_plan(fields, sortkeys):
+    keyed = field_sort.SortPlan(sortkeys).assign_keys(fields)
+    return field_sort.extract_order(field_sort.sort_fields(keyed))
+
+def engine_runs(fields, sortkeys):
+    keyed = field_sort.SortPlan(sortkeys).assign_keys(fields)
+    runs  = field_sort.find_runs(keyed)
+    return field_sort.extract_order(field_sort.sort_fields(keyed, runs))
+
+def engine_packed(fields, sortkeys):
+    keyed  = field_sort.SortPlan(sortkeys).assign_keys(fields)
+    packed = field_sort.pack_integer_keys(keyed)
+    if packed is None:
+        return reference_order(fields, sortkeys)
+    return field_sort.extract_order(keyed[idx] for idx in sorted(range(0, len(keyed)), key=packed.__getitem__))
+
+def engine_top(fields, sortkeys):
+    keys = field_sort.SortPlan(sortkeys).line_keys(fields)
+    top  = max(1, len(keys) // 2)
+    ordered, rest = field_sort.select_top(keys, range(0, len(keys)), top)
+    # the rest all sort after the top, or tie and come after them
+    return ordered + sorted(rest, key=keys.__getitem__)
+
+def engine_preview(fields, sortkeys):
+    preview = field_sort.Preview(fields)
+    top   = preview.first_order(sortkeys, max(1, len(fields) // 2))
+    every = preview.first_order(sortkeys, len(fields))
+    chosen = set(top)
+    return top + [idx for idx in every if idx not in chosen]
+
+def engine_builder(fields, sortkeys):
+    # a KeyBuilder stopped part way through
+    builder = field_sort.KeyBuilder(fields, 3, field_sort.AppLanguage)
+    for (column, sort_as, sort_lang), values in builder.columns.items():
+        field_sort.column_values(fields, column, sort_as, sort_lang, values, len(fields) // 2)
+    keyed = field_sort.SortPlan(sortkeys).assign_keys(fields, builder.columns)
+    return field_sort.extract_order(field_sort.sort_fields(keyed))
+
+def engine_insert(fields, sortkeys):
+    order = field_sort.insert_order(field_sort.SortPlan(sortkeys), fields)
+    if order is None:
+        return list(range(fields.head, fields.head+len(fields)))
+    return order
+
+ENGINES = {
+    'plan':    engine_plan,
+    'runs':    engine_runs,
+    'packed':  engine_packed,
+    'top':     engine_top,
+    'builder': engine_builder,
+    'preview': engine_preview,
+    'insert':  engine_insert,
+}
+
+
+# --------------------------------------
+def pipeline(marked, sortkeys, extra=()):
+    '''
+          Name: pipeline
+         Usage: status, output = pipeline(marked, sortkeys, extra)
+       Purpose: Sort the page as Zim would have it sorted.
+    Parameters: marked   -- the Zim marked text
+                sortkeys -- ((field#,sort_as,order,language),...)
+                extra    -- optional, more options, like --unique
+       Returns: status   -- from sort_selection()
+                output   -- the text that replaces the selection
+    '''
+    keys = []
+    for sort_on, sort_as, sort_order, sort_lang in sortkeys:
+        if sort_on == str(field_sort.ID_ENTIRE_LINE):
+            sort_on = field_sort.ID_LINE
+        keys.append('--key=' + ':'.join((sort_on, sort_as, sort_order, sort_lang)))
+    # %T only; field_sort.unmark() is checked against unmark() here
+    options = field_sort.read_options(keys + list(extra) + ['--', marked])
+    status, output = field_sort.sort_selection(options)
+    return status, output
+
+
+# --------------------------------------
+def failures(marked, sortkeys, extra=()):
+    '''
+          Name: failures
+         Usage: failed = failures(marked, sortkeys, extra)
+       Purpose: Sort a page every way and compare. With more options,
+                or on a table, only sort_selection() can do it.
+    Parameters: marked   -- the Zim marked text
+                sortkeys -- ((field#,sort_as,order,language),...)
+                extra    -- optional, more options, like --unique
+       Returns: failed   -- [(engine,got,wanted),...]
+    '''
+    failed = check_selection(marked, sortkeys, extra)
+    if extra or reference_table(reference_split(marked)[1]) is not None:
+        return failed
+
+    wanted = reference_order(marked, sortkeys)
+
+    # only the engines use Field Sort's own lines and fields
+    rows   = reference_fields(reference_split(marked)[1])
+    marked_lines = field_sort.Lines(marked)
+    text_lines   = field_sort.Lines(unmark(marked))
+    if len(text_lines) != len(marked_lines):
+        text_lines = None   # as sort_selection() does
+    fields = field_sort.get_fields(text_lines, marked_lines)[1]
+    got = [tuple(fields.marked.text[fields.starts[pos]:fields.ends[pos]]
+                 for pos in range(fields.first[idx], fields.first[idx+1]))
+           for idx in range(0, len(fields))]
+    if got != [row[1:-1] for row in rows]:
+        return [('get_fields', got, [row[1:-1] for row in rows])]
+
+    for name, engine in ENGINES.items():
+        try:
+            got = engine(fields, sortkeys)
+        except Exception as error:
+            got = repr(error)
+        if got != wanted:
+            failed.append((name, got, wanted))
+
+    keyed = field_sort.SortPlan(sortkeys).assign_keys(fields)
+    if (field_sort.find_disorder(keyed) is None) != (wanted == sorted(wanted)):
+        failed.append(('find_disorder', field_sort.find_disorder(keyed), wanted))
+
+    return failed
+
+
+# --------------------------------------
+def check_selection(marked, sortkeys, extra=()):
+    '''
+          Name: check_selection
+         Usage: failed = check_selection(marked, sortkeys, extra)
+       Purpose: Compare the whole of sort_selection() with the plain way.
+    Parameters: marked   -- the Zim marked text
+                sortkeys -- ((field#,sort_as,order,language),...)
+                extra    -- optional, more options, like --unique
+       Returns: failed   -- [('sort_selection',got,wanted)] or []
+    '''
+    output = reference_selection(marked, sortkeys, extra)
+    try:
+        got = pipeline(marked, sortkeys, extra)
+    except Exception as error:
+        got = repr(error)
+    if got != (field_sort.SUCCESS, output):
+        return [('sort_selection', got, output)]
+    return []
+
+
+# --------------------------------------
+def shrink(marked, sortkeys, extra=()):
+    '''
+          Name: shrink
+         Usage: marked, sortkeys = shrink(marked, sortkeys, extra)
+       Purpose: Remove lines and sortkeys for as long as the sort
+                still fails.
+    Parameters: marked   -- the Zim marked text, which fails
+                sortkeys -- ((field#,sort_as,order,language),...)
+                extra    -- optional, more options, like --unique
+       Returns: marked   -- the fewest lines that still fail
+                sortkeys -- the fewest sortkeys that still fail
+    '''
+    smaller = True
+    while smaller:
+        smaller = False
+        lines = marked.split('\n')
+        for idx in range(0, len(lines)):
+            tried = '\n'.join(lines[:idx] + lines[idx+1:])
+            if failures(tried, sortkeys, extra):
+                marked, smaller = tried, True
+                break
+        for idx in range(0, len(sortkeys)):
+            tried = sortkeys[:idx] + sortkeys[idx+1:]
+            if tried and failures(marked, tried, extra):
+                sortkeys, smaller = tried, True
+                break
+
+    return marked, sortkeys
+
+
+# --------------------------------------
+def main():
+    '''
+          Name: main
+         Usage: main()
+       Purpose: Isolates execution of the program from importing.
+    Parameters: (none)
+       Returns: (none)
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', type=int, default=500)
+    parser.add_argument('--seed',  type=int, default=random.randrange(1000000))
+    args = parser.parse_args()
+
+    field_sort.load_languages()
+    languages = [field_sort.ID_NONE]
+    if field_sort.AppLanguage is not None:
+        languages.append(field_sort.AppLanguage)
+
+    rng   = random.Random(args.seed)
+    seeds = seed_pages()
+    print('seed', args.seed)
+    for case in range(0, args.cases):
+        marked, extra = random_page(rng, seeds)
+        sortkeys = random_sortkeys(rng, languages)
+        if not failures(marked, sortkeys, extra):
+            continue
+
+        marked, sortkeys = shrink(marked, sortkeys, extra)
+        print('case', case, 'fails')
+        print('marked:  ', repr(marked))
+        print('sortkeys:', sortkeys)
+        print('options: ', extra)
+        for name, got, wanted in failures(marked, sortkeys, extra):
+            print(name)
+            print('     got:', got)
+            print('  wanted:', wanted)
+        exit(1)
+
+    print(args.cases, 'cases, all the same')
+
+
+# don't execute if imported
+if __name__ == '__main__':
+    main()